@@ -0,0 +1,40 @@
+"""
+Helpers to load parquet files written by `scripts/export_parquet.py` into pandas dataframes.
+
+    from parquet_loader import load_launches, load_repos
+    launches = load_launches("parquet", start_month="2020-01", end_month="2020-06", columns=["timestamp", "provider"])
+"""
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+
+LAUNCH_TABLE = "mybinderlaunch"
+REPO_TABLE = "repo"
+
+
+def _load_table(table_dir, start_month=None, end_month=None, columns=None):
+    """reads partitions (month=YYYY-MM) of a table between given months (both inclusive).
+    only partitions in the month range and the given columns are read, strings are read as categories."""
+    dataset = ds.dataset(table_dir, format="parquet", partitioning="hive")
+    month_filter = None
+    if start_month:
+        month_filter = ds.field("month") >= start_month
+    if end_month:
+        end_filter = ds.field("month") <= end_month
+        month_filter = end_filter if month_filter is None else month_filter & end_filter
+    table = dataset.to_table(columns=columns, filter=month_filter)
+    return table.to_pandas()
+
+
+def load_launches(parquet_dir="parquet", start_month=None, end_month=None, columns=None):
+    """loads launches between start_month and end_month (YYYY-MM, both inclusive).
+    timestamp column is converted into datetime."""
+    df = _load_table(os.path.join(parquet_dir, LAUNCH_TABLE), start_month, end_month, columns)
+    if "timestamp" in df.columns:
+        df["timestamp"] = pd.to_datetime(df["timestamp"])
+    return df
+
+
+def load_repos(parquet_dir="parquet", start_month=None, end_month=None, columns=None):
+    """loads repos which are first launched between start_month and end_month (YYYY-MM, both inclusive)"""
+    return _load_table(os.path.join(parquet_dir, REPO_TABLE), start_month, end_month, columns)
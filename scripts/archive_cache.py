@@ -0,0 +1,233 @@
+"""
+Local, content-addressed store for mybinder.org events archive files (https://archive.analytics.mybinder.org/)
+
+Layout of the cache folder:
+
+    objects/<sha256[:2]>/<sha256>   content of archive files, named by their hash
+    refs/events-<date>.jsonl.json   metadata of each archive file: sha256, etag, last_modified, fetched_at
+
+ArchiveDownloader fills the cache concurrently in a background thread.
+"""
+import os
+import json
+import queue
+import asyncio
+import hashlib
+import tempfile
+import threading
+import aiohttp
+import requests
+from datetime import datetime
+
+ARCHIVE_URL = "https://archive.analytics.mybinder.org"
+DEFAULT_CACHE_DIR = "archive_cache"
+
+
+class ArchiveNotCachedError(FileNotFoundError):
+    pass
+
+
+class ArchiveCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, archive_url=ARCHIVE_URL, offline=False, timeout=300):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.archive_url = archive_url.rstrip("/")
+        self.offline = offline
+        self.timeout = timeout
+        os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, "refs"), exist_ok=True)
+
+    def _ref_path(self, a_name):
+        return os.path.join(self.cache_dir, "refs", f"{a_name}.json")
+
+    def _object_path(self, sha256):
+        return os.path.join(self.cache_dir, "objects", sha256[:2], sha256)
+
+    def get_ref(self, a_name):
+        """returns cached metadata of the archive file or None"""
+        try:
+            with open(self._ref_path(a_name), "r") as f:
+                ref = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(self._object_path(ref["sha256"])):
+            # object is removed by hand, fetch it again
+            return None
+        return ref
+
+    def _write_atomic(self, path, data):
+        # write into a temp file in the same folder and then rename,
+        # so parallel readers never see a partially written file
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def store(self, a_name, content, etag=None, last_modified=None):
+        """saves content of an archive file and returns its metadata"""
+        sha256 = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(sha256)
+        if not os.path.exists(object_path):
+            self._write_atomic(object_path, content)
+        ref = {
+            "name": a_name,
+            "sha256": sha256,
+            "size": len(content),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": datetime.utcnow().replace(microsecond=0).isoformat(),
+        }
+        self._write_atomic(self._ref_path(a_name), json.dumps(ref, indent=1).encode())
+        return ref
+
+    def touch(self, a_name, ref):
+        """updates fetch time of a cached archive file, e.g. after a 304 response"""
+        ref = dict(ref, fetched_at=datetime.utcnow().replace(microsecond=0).isoformat())
+        self._write_atomic(self._ref_path(a_name), json.dumps(ref, indent=1).encode())
+        return ref
+
+    @staticmethod
+    def is_immutable(archive_date):
+        # archive of a past day is not updated anymore
+        return archive_date < datetime.utcnow().date()
+
+    def get_conditional_headers(self, ref):
+        headers = {}
+        if ref is None:
+            return headers
+        if ref["etag"]:
+            headers["If-None-Match"] = ref["etag"]
+        if ref["last_modified"]:
+            headers["If-Modified-Since"] = ref["last_modified"]
+        return headers
+
+    def _get_cached(self, archive_date):
+        """returns (a_name, ref, True) if cached archive can be used without a request, otherwise (a_name, ref, False)"""
+        a_name = f"events-{str(archive_date)}.jsonl"
+        ref = self.get_ref(a_name)
+        if ref is not None and (self.offline or self.is_immutable(archive_date)):
+            return a_name, ref, True
+        if self.offline:
+            raise ArchiveNotCachedError(f"{a_name} is not in cache {self.cache_dir}")
+        return a_name, ref, False
+
+    def fetch(self, archive_date):
+        """returns (path, sha256) of the archive file of given date.
+        archives of past days are fetched only once, archive of today is revalidated with a conditional request.
+        in offline mode only the cache is used."""
+        a_name, ref, cached = self._get_cached(archive_date)
+        if cached:
+            return self._object_path(ref["sha256"]), ref["sha256"]
+
+        response = requests.get(f"{self.archive_url}/{a_name}",
+                                headers=self.get_conditional_headers(ref),
+                                timeout=self.timeout)
+        if response.status_code == 304 and ref is not None:
+            ref = self.touch(a_name, ref)
+        else:
+            response.raise_for_status()
+            ref = self.store(a_name, response.content,
+                             response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return self._object_path(ref["sha256"]), ref["sha256"]
+
+    async def fetch_async(self, session, archive_date):
+        """same as fetch, but with an aiohttp session, so many archives can be downloaded concurrently"""
+        a_name, ref, cached = self._get_cached(archive_date)
+        if cached:
+            return self._object_path(ref["sha256"]), ref["sha256"]
+
+        async with session.get(f"{self.archive_url}/{a_name}", headers=self.get_conditional_headers(ref)) as response:
+            if response.status == 304 and ref is not None:
+                ref = self.touch(a_name, ref)
+            else:
+                response.raise_for_status()
+                content = await response.read()
+                # hashing and writing large files would block other downloads
+                ref = await asyncio.get_event_loop().run_in_executor(
+                    None, self.store, a_name, content,
+                    response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return self._object_path(ref["sha256"]), ref["sha256"]
+
+
+class ArchiveDownloader:
+    """
+    Downloads archives into an archive cache with asyncio in a background thread,
+    so processes which parse archives dont wait for the network.
+    At most `concurrency` archives are downloaded at the same time over a pooled http session and
+    at most `prefetch` archives are downloaded (or being downloaded) ahead of the consumer.
+
+        downloader = ArchiveDownloader(archive_cache)
+        downloader.start()
+        downloader.request(archive_date)
+        archive_date, path, sha256, exception = downloader.get()
+        downloader.stop()
+    """
+    def __init__(self, archive_cache, concurrency=4, prefetch=8):
+        self.archive_cache = archive_cache
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        # (archive_date, path, sha256, exception) of fetched archives
+        self.fetched = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self._started = threading.Event()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        # asyncio objects are created in the loop of this thread
+        self.requests = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.prefetch)
+        self.stopped = asyncio.Event()
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        # same as timeout of requests: for connecting and between received bytes, not for the whole download
+        timeout = aiohttp.ClientTimeout(sock_connect=self.archive_cache.timeout, sock_read=self.archive_cache.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = [asyncio.ensure_future(self._download(session)) for _ in range(self.concurrency)]
+            self._started.set()
+            await self.stopped.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _download(self, session):
+        while True:
+            archive_date = await self.requests.get()
+            # wait until the consumer takes one of the prefetched archives
+            await self.slots.acquire()
+            try:
+                path, sha256 = await self.archive_cache.fetch_async(session, archive_date)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.fetched.put((archive_date, None, None, e))
+            else:
+                self.fetched.put((archive_date, path, sha256, None))
+
+    def start(self):
+        self.thread.start()
+        self._started.wait()
+
+    def request(self, archive_date):
+        """adds an archive to download, archives are downloaded in order of requests"""
+        self.loop.call_soon_threadsafe(self.requests.put_nowait, archive_date)
+
+    def get(self, block=True, timeout=None):
+        """returns (archive_date, path, sha256, exception) of a fetched archive or None if there is none"""
+        try:
+            fetched = self.fetched.get(block, timeout)
+        except queue.Empty:
+            return None
+        self.loop.call_soon_threadsafe(self.slots.release)
+        return fetched
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.thread.join()
@@ -0,0 +1,296 @@
+"""
+Script to benchmark the ingest path (parse_mybinder_archive.py and the following scripts)
+without hitting the live archive: archive files (e.g. output of generate_archive.py)
+are served from a local http server.
+
+Stages:
+- download: fetch archives into an empty archive cache
+- parse: read and parse archives in a single process, without writing into the database
+- ingest: parse_mybinder_archive with the archive cache of the download stage
+- repos: create_repo_table without GitHub API
+- export: export_parquet
+
+Each stage runs in its own process, so peak RSS is measured per stage.
+"""
+import os
+import json
+import shutil
+import argparse
+import resource
+import threading
+import subprocess
+import multiprocessing
+from time import time
+from datetime import datetime
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from archive_cache import ArchiveCache, ArchiveDownloader
+from generate_archive import generate_archive, R2D_HISTORY_FILE
+from utils import get_logger, get_utc_ts, get_r2d_history_index
+
+STAGES = ["download", "parse", "ingest", "repos", "export"]
+DEFAULT_WORK_DIR = "benchmark"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_archive(archive_dir):
+    """serves archive_dir in a background thread, returns the server"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=archive_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_archive_dates(archive_dir):
+    dates = []
+    for name in sorted(os.listdir(archive_dir)):
+        if name.startswith("events-") and name.endswith(".jsonl"):
+            dates.append(datetime.strptime(name[len("events-"):-len(".jsonl")], "%Y-%m-%d").date())
+    return dates
+
+
+def get_size(path):
+    """returns size of a file or a folder in bytes"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _download(config):
+    import parse_mybinder_archive
+    archive_cache = ArchiveCache(config["cache_dir"], config["archive_url"])
+    downloader = ArchiveDownloader(archive_cache, parse_mybinder_archive.DOWNLOAD_WORKERS, len(config["dates"]))
+    downloader.start()
+    for archive_date in config["dates"]:
+        downloader.request(archive_date)
+    try:
+        for _ in config["dates"]:
+            archive_date, _, _, exc = downloader.get()
+            if exc is not None:
+                raise exc
+    finally:
+        downloader.stop()
+    return config["cache_dir"]
+
+
+def _parse(config):
+    import parse_mybinder_archive
+    archive_cache = ArchiveCache(config["cache_dir"], offline=True)
+    r2d_index = get_r2d_history_index(config["r2d_history"])
+    for archive_date in config["dates"]:
+        archive_path, _ = archive_cache.fetch(archive_date)
+        for df in parse_mybinder_archive.read_archive(archive_path, config["read_batch_size"]):
+            parse_mybinder_archive.parse_events(df, f"events-{archive_date}.jsonl", r2d_index)
+    return None
+
+
+def _ingest(config):
+    import parse_mybinder_archive
+    parse_mybinder_archive.logger = logger
+    archive_cache = ArchiveCache(config["cache_dir"], offline=True)
+    parse_mybinder_archive.parse_mybinder_archive(config["dates"][0], config["dates"][-1], config["db_name"],
+                                                  config["max_workers"], False, archive_cache,
+                                                  r2d_history=config["r2d_history"],
+                                                  read_batch_size=config["read_batch_size"],
+                                                  compact=config["compact"])
+    return config["db_name"]
+
+
+def _repos(config):
+    import create_repo_table
+    create_repo_table.logger = logger
+    create_repo_table.verbose = False
+    create_repo_table.create_repo_table(config["db_name"], ['"GitHub"', '"Gist"'], 0,
+                                        max_workers=config["max_workers"])
+    return config["db_name"]
+
+
+def _export(config):
+    import export_parquet
+    export_parquet.logger = logger
+    export_parquet.verbose = False
+    export_parquet.export_parquet(config["db_name"], config["parquet_dir"])
+    return config["parquet_dir"]
+
+
+STAGE_FUNCTIONS = {
+    "download": _download,
+    "parse": _parse,
+    "ingest": _ingest,
+    "repos": _repos,
+    "export": _export,
+}
+
+
+def _run_stage(stage, config, results):
+    start_time = time()
+    output_path = STAGE_FUNCTIONS[stage](config)
+    duration = time() - start_time
+    # ru_maxrss is in kilobytes on linux,
+    # RUSAGE_CHILDREN is the largest worker process of this stage
+    results.put({
+        "seconds": duration,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "workers_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "size_mb": get_size(output_path) / 1024 ** 2 if output_path else None,
+    })
+
+
+def run_stage(stage, config):
+    """runs a stage in a new process and returns its measurements"""
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(stage, config, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception(f"stage {stage} failed with exit code {process.exitcode}")
+    return results.get()
+
+
+def benchmark_ingest(archive_dir, work_dir, stages, max_workers=4, compact=False, read_batch_size=None):
+    """runs given stages with archives in archive_dir, returns list of results per stage"""
+    import parse_mybinder_archive
+    dates = get_archive_dates(archive_dir)
+    if not dates:
+        raise Exception(f"there is no archive file in {archive_dir}")
+    event_count = 0
+    for archive_date in dates:
+        with open(os.path.join(archive_dir, f"events-{archive_date}.jsonl"), "rb") as f:
+            event_count += sum(1 for line in f if line.strip())
+    with open(os.path.join(archive_dir, R2D_HISTORY_FILE), "r") as f:
+        r2d_history = json.load(f)
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    server = serve_archive(archive_dir)
+    config = {
+        "dates": dates,
+        "archive_url": f"http://127.0.0.1:{server.server_port}",
+        "cache_dir": os.path.join(work_dir, "archive_cache"),
+        "db_name": os.path.join(work_dir, "benchmark.db"),
+        "parquet_dir": os.path.join(work_dir, "parquet"),
+        "r2d_history": r2d_history,
+        "max_workers": max_workers,
+        "compact": compact,
+        "read_batch_size": read_batch_size or parse_mybinder_archive.READ_BATCH_SIZE,
+    }
+    results = []
+    try:
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            msg = f"running stage {stage}"
+            if verbose:
+                print(msg)
+            logger.info(msg)
+            result = run_stage(stage, config)
+            result["stage"] = stage
+            result["events"] = event_count
+            result["events_per_sec"] = event_count / result["seconds"]
+            results.append(result)
+            logger.info(json.dumps(result))
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(results):
+    print(f"{'stage':<10}{'seconds':>10}{'events/sec':>14}{'peak RSS MB':>14}{'workers MB':>12}{'size MB':>10}")
+    for r in results:
+        size = f"{r['size_mb']:.1f}" if r["size_mb"] is not None else "-"
+        print(f"{r['stage']:<10}{r['seconds']:>10.2f}{r['events_per_sec']:>14.0f}{r['peak_rss_mb']:>14.1f}"
+              f"{r['workers_peak_rss_mb']:>12.1f}{size:>10}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='This script benchmarks the ingest path with archive files '
+                                                 'served from a local http server and reports '
+                                                 'events/sec, peak RSS and output size per stage '
+                                                 f'({", ".join(STAGES)}).'
+                                                 '\nIf archive folder is empty, archives are generated first '
+                                                 '(see generate_archive.py).'
+                                                 '\nExample command to benchmark 7 days with 50000 events per day: '
+                                                 '\n\tpython benchmark_ingest.py -v -d 7 -e 50000',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-a', '--archive_dir', required=False, default="synthetic_archive",
+                        help='Folder of archive files. Default is synthetic_archive.')
+    parser.add_argument('-s', '--start_date', required=False, default="2019-06-10",
+                        help='Date of the first archive to generate. Default is 2019-06-10.')
+    parser.add_argument('-d', '--days', type=int, default=7,
+                        help='Number of archive days to generate. Default is 7.')
+    parser.add_argument('-e', '--events_per_day', type=int, default=10000,
+                        help='Average number of events per day to generate. Default is 10000.')
+    parser.add_argument('-w', '--work_dir', required=False, default=DEFAULT_WORK_DIR,
+                        help=f'Folder for archive cache, database and parquet files, '
+                             f'it is removed at start. Default is {DEFAULT_WORK_DIR}.')
+    parser.add_argument('--stages', required=False, default=",".join(STAGES),
+                        help=f'Comma-separated list of stages to run. Default is "{",".join(STAGES)}". '
+                             f'Stages after download use its archive cache, repos and export use the database.')
+    parser.add_argument('-m', '--max_workers', type=int, default=4, help='Max number of processes to run in parallel. '
+                                                                         'Default is 4.')
+    parser.add_argument('--compact', required=False, default=False, action='store_true',
+                        help='Save launches in compact form. Default is False.')
+    parser.add_argument('--read_batch_size', type=int, required=False, default=None,
+                        help='Number of events to read and parse at once.')
+    parser.add_argument('-o', '--output', required=False, default=None,
+                        help='File to append results as json lines, e.g. to compare runs of different commits.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='Default is False.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    global verbose
+    global logger
+
+    args = get_args()
+    verbose = args.verbose
+    stages = [s.strip() for s in args.stages.split(",")]
+    for stage in stages:
+        if stage not in STAGES:
+            raise Exception(f"unknown stage: {stage}")
+
+    script_ts, script_ts_safe = get_utc_ts()
+    logger_name = f'{os.path.basename(__file__)[:-3]}_at_{script_ts_safe}'.replace("-", "_")
+    logger = get_logger(logger_name)
+    if verbose:
+        print(f"Logs are in {logger_name}.log")
+
+    if not os.path.exists(args.archive_dir) or not get_archive_dates(args.archive_dir):
+        start_date = datetime.strptime(args.start_date, '%Y-%m-%d').date()
+        event_count = generate_archive(args.archive_dir, start_date, args.days, args.events_per_day,
+                                       repo_count=max(1000, args.events_per_day // 5))
+        if verbose:
+            print(f"{event_count} events are generated into {args.archive_dir}")
+
+    results = benchmark_ingest(args.archive_dir, args.work_dir, stages, args.max_workers, args.compact,
+                               args.read_batch_size)
+    print_results(results)
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                result.update({"ts": script_ts, "commit": get_git_commit(), "max_workers": args.max_workers,
+                               "compact": args.compact, "archive_dir": args.archive_dir})
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,15 +8,19 @@ from utils import get_repo2docker_image, get_logger, get_image_name, get_utc_ts,
      REPO_TABLE as repo_table, EXECUTION_TABLE as execution_table, \
      DEFAULT_IMAGE_PREFIX as default_image_prefix, Timeout, BuildTimeoutException, check_if_exists
 from datetime import datetime
+from contextlib import nullcontext
 from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures import as_completed
 from sqlite_utils import Database
+from repo_cache import RepoCache, DEFAULT_MAX_SIZE_GB
 
 # time out for python docker client
 DOCKER_TIMEOUT = 300
 # https://github.com/jupyterhub/binderhub/blob/b81d913f66236cab840c437975683fbcac1e6e62/binderhub/app.py#L435-L443
 # we dont guarantee 2 cpus for image building, so use higher timeout
 BUILD_TIMEOUT = 3600 * 6
+# path of the repo mirror in repo2docker container
+MIRROR_MOUNT_PATH = "/srv/repo_mirror.git"
 
 
 def create_dir(dir_path):
@@ -251,19 +255,28 @@ def build_image(repo_id, repo_url, image_name, resolved_ref):
         ]
         if push:
             cmd.append("--push")
-        cmd.append(repo_url)
+        volumes = {
+            "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"}
+        }
+        if repo_cache is not None:
+            # repo2docker clones from the local mirror of the repo, which is mounted read-only
+            cmd.append(f"file://{MIRROR_MOUNT_PATH}")
+            mirror = repo_cache.mirror(repo_url, resolved_ref)
+        else:
+            cmd.append(repo_url)
+            mirror = nullcontext()
         _, ts_safe = get_utc_ts()
         log_file_name = f'{repo_id}_{image_name.replace("/", "-").replace(":", "-")}_{ts_safe}.log'
-        with open(os.path.join(build_log_folder, log_file_name), 'w') as log_file:
+        with open(os.path.join(build_log_folder, log_file_name), 'w') as log_file, mirror as mirror_path:
+            if mirror_path:
+                volumes[mirror_path] = {"bind": MIRROR_MOUNT_PATH, "mode": "ro"}
             try:
                 # https://docker-py.readthedocs.io/en/stable/containers.html#docker.models.containers.ContainerCollection.run
                 container = client.containers.run(
                     image=r2d_version,
                     command=cmd,
                     name=f"{repo_id}-image-build-{script_ts_safe}",
-                    volumes={
-                        "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"}
-                    },
+                    volumes=volumes,
                     # set memory limit same as in mybinder.org:
                     # https://github.com/jupyterhub/mybinder.org-deploy/blob/4cfbd9c7975d5d8b6cccbb02974be8aca499b228/config/prod.yaml#L33
                     mem_limit="12g",
@@ -582,6 +595,12 @@ def get_args():
                         help='Number of images to save locally before deleting them. Default is 500.')
     parser.add_argument('-m', '--max_workers', type=int, default=4, help='Max number of processes to run in parallel. '
                                                                          'Default is 4.')
+    parser.add_argument('-rc', '--repo_cache', required=False, default=None,
+                        help='Folder of local mirrors of repos (see repo_cache.py). If it is given, repo2docker '
+                             'clones repos from their mirrors and only new commits are fetched from remote.')
+    parser.add_argument('-rcs', '--repo_cache_size', type=float, default=DEFAULT_MAX_SIZE_GB,
+                        help=f'Disk budget of repo cache in GB, least recently used mirrors are removed. '
+                             f'Default is {DEFAULT_MAX_SIZE_GB}.')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
                         help='Default is False.')
     args = parser.parse_args()
@@ -604,6 +623,7 @@ def main():
     global script_ts_safe
     global notebooks_range
     global force_build
+    global repo_cache
 
     args = get_args()
     db_name = args.db_name
@@ -621,6 +641,7 @@ def main():
     force_build = args.force_build
     image_prefix = args.image_prefix
     max_workers = args.max_workers
+    repo_cache = RepoCache(args.repo_cache, args.repo_cache_size) if args.repo_cache else None
     verbose = args.verbose
 
     # script_ts is used in outputs of this image (in database, logs and outputs),
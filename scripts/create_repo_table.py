@@ -7,76 +7,306 @@ import pandas as pd
 from datetime import datetime
 from concurrent.futures.process import ProcessPoolExecutor
 # from concurrent.futures.thread import ThreadPoolExecutor
-from concurrent.futures import as_completed
+from concurrent.futures import wait, FIRST_COMPLETED
+from collections import deque
 from sqlite_utils import Database
 from time import sleep
-from utils import get_ref, get_repo_data_from_github_api, get_logger, GithubException, \
+from launch_db import set_launch_repo_ids, rollups_exist, daily_repo_table, get_ingested_until
+from repo_cache import RepoCache, DEFAULT_MAX_SIZE_GB
+from token_pool import start_token_pool
+from response_cache import ResponseCache
+from git_engine import GitEngine, DEFAULT_HOST_CONCURRENCY
+from utils import get_ref, get_repo_data_from_github_api, get_logger, GithubException, RateLimitExceededException, \
     get_repo_data_from_git, LAUNCH_TABLE as launch_table, REPO_TABLE as repo_table, \
-    get_utc_ts, check_if_exists
+    INGEST_MANIFEST_TABLE as manifest_table, \
+    get_utc_ts, check_if_exists, get_repos_data_from_github_graphql, GITHUB_API_URL, GRAPHQL_BATCH_SIZE
 
 
-def get_repos_from_launch_table(db, providers, launch_limit):
-    # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_sql_query.html
-    # https://developer.github.com/v3/#rate-limiting
-    chunk_size = 5000
-    # NOTE: this query orders launch table by timestamp and creates a temporary table t
-    # and this temporary table is used to select and also to concat specs, so we have specs in time order and
-    # we can use the last launched one to fetch resolved_ref
-    # BUT sqlite docs (https://www.sqlite.org/lang_aggfunc.html#groupconcat) says
-    # GROUP_CONCAT: The order of the concatenated elements is arbitrary.
-    # that's why first we concat timestamp and spec (ts_spec) and then concat all ts_specs of a repo
-    # later we will sort and get last launched spec
-    query = f"""SELECT t.provider AS provider, t.repo_url AS repo_url, 
-                       COUNT(t.repo_url) AS launch_count, 
-                       MIN(t.timestamp) AS first_launch_ts, 
-                       MAX(t.timestamp) AS last_launch_ts, 
-                       GROUP_CONCAT(DISTINCT t.ts_spec) AS ts_specs 
-                FROM (SELECT provider, repo_url, timestamp, 
-                             (timestamp || ";" || spec) AS ts_spec, 
-                             ref, resolved_ref 
-                      FROM {launch_table} 
-                      ORDER BY timestamp) AS t 
-                WHERE provider IN ({", ".join(providers)}) 
-                GROUP BY repo_url 
-                HAVING launch_count > {launch_limit} 
-                ORDER BY first_launch_ts;"""
+# number of repos to insert in one transaction
+WRITE_BATCH_SIZE = 1000
+# max number of finished repos which wait for a slower repo with a lower id
+REORDER_WINDOW = 10000
+
+# columns of candidate tables, launches aggregated per repo
+CANDIDATE_COLUMNS = {
+    "id": int,
+    "provider": str,
+    "repo_url": str,
+    "launch_count": int,
+    "first_launch_ts": str,
+    "last_launch_ts": str,
+    "last_spec": str,
+}
+
+# staging table of repos to process, it is created once from launches and removed when repo table is complete
+candidate_table = f"{repo_table}_candidate"
+# temporary tables of an incremental refresh: aggregated launches of repos with new launches
+# and repos of these, which are new or changed and must be processed again.
+# an interrupted refresh is not resumed, it is just run again, repos which are already updated are not changed anymore
+delta_table = f"{repo_table}_delta"
+refresh_candidate_table = f"{repo_table}_refresh_candidate"
+# one row per complete run, ingested_until is the watermark of the next incremental refresh
+refresh_table = f"{repo_table}_refresh"
+REFRESH_COLUMNS = {
+    # when the run is finished
+    "refreshed_at": str,
+    # ingested_at of the last archive day (see launch_db.MANIFEST_COLUMNS) which was saved before the run
+    "ingested_until": str,
+}
+
+
+def _get_candidates_query(db, providers, launch_limit, since=None):
+    """returns query and its params to aggregate launches per repo,
+    if since is given, only repos with launches in archive days which are ingested since then"""
+    params = []
+    repo_filter = ""
+    if rollups_exist(db):
+        # daily rollups (see launch_db.LaunchWriter) are much smaller than the launch table,
+        # they have number of launches, first and last launch and last spec of each repo per day
+        table, launch_count, timestamp, spec = daily_repo_table, "SUM(launch_count)", "last_launch_ts", "last_spec"
+        first_launch_ts = "MIN(first_launch_ts)"
+        # rollups of older databases dont have the index to select last spec (see LaunchWriter._create_rollups)
+        db.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{daily_repo_table}_repo_url_last_launch_ts_last_spec "
+                        f"ON {daily_repo_table} (repo_url, last_launch_ts, last_spec);")
+        if since is not None:
+            # all launches of these repos are aggregated, not only the new ones,
+            # so counts are correct even if an archive day is parsed again
+            repo_filter = f"""AND repo_url IN (SELECT repo_url FROM {daily_repo_table} 
+                                               WHERE date IN (SELECT archive_date FROM {manifest_table} 
+                                                              WHERE ingested_at >= ?)) """
+            params.append(since)
+    else:
+        # new launches can't be found without rollups, all repos are compared
+        table, launch_count, timestamp, spec = launch_table, "COUNT(*)", "timestamp", "spec"
+        first_launch_ts = "MIN(timestamp)"
+    # spec of the last launch is selected in sqlite for each repo:
+    # subquery finds rows of the repo at its last launch timestamp with an index search
+    # (index on (repo_url, timestamp, spec), see launch_db.LAUNCH_INDEXES and LaunchWriter._create_rollups),
+    # if there are more launches at that timestamp, MAX makes the selection deterministic.
+    # HAVING uses the aggregate, because alias launch_count would refer to the column of rollups
+    query = f"""SELECT r.provider AS provider, r.repo_url AS repo_url, 
+                       r.launch_count AS launch_count, 
+                       r.first_launch_ts AS first_launch_ts, 
+                       r.last_launch_ts AS last_launch_ts, 
+                       (SELECT MAX(l.{spec}) 
+                        FROM {table} AS l 
+                        WHERE l.repo_url = r.repo_url AND l.{timestamp} = r.last_launch_ts) AS last_spec 
+                FROM (SELECT provider, repo_url, 
+                             {launch_count} AS launch_count, 
+                             {first_launch_ts} AS first_launch_ts, 
+                             MAX({timestamp}) AS last_launch_ts 
+                      FROM {table} 
+                      WHERE provider IN ({", ".join(providers)}) {repo_filter}
+                      GROUP BY repo_url 
+                      HAVING {launch_count} > {launch_limit}) AS r 
+                ORDER BY r.first_launch_ts"""
     logger.info(query)
-    df_iter = pd.read_sql_query(query, db.conn, chunksize=chunk_size)
-    count = db.conn.execute(f"SELECT count(*) FROM ({query[:-1]});").fetchone()[0]
-    return df_iter, count
+    return query, params
+
+
+def create_repo_candidates(db, providers, launch_limit):
+    """aggregates launches per repo into candidate table, ids are in order of first launch.
+    returns number of repos"""
+    query, params = _get_candidates_query(db, providers, launch_limit)
+    # aggregation query runs only once, its result is saved with ids (integer primary key)
+    # and it is used for counting, for iterating in chunks and to resume later
+    if candidate_table in db.table_names():
+        db[candidate_table].drop()
+    db[candidate_table].create(CANDIDATE_COLUMNS, pk="id")
+    with db.conn:
+        db.conn.execute(f"INSERT INTO {candidate_table} ({', '.join(list(CANDIDATE_COLUMNS)[1:])}) {query};",
+                        params)
+    return db.conn.execute(f"SELECT count(*) FROM {candidate_table};").fetchone()[0]
+
+
+def create_refresh_candidates(db, providers, launch_limit, since, changed=True):
+    """aggregates launches of repos with new launches since the last refresh (all repos if since is None)
+    into delta table and selects repos to process into refresh candidate table:
+    new repos get new ids in order of first launch, repos whose last launch or last spec is changed keep their ids.
+    if changed is False, only new repos are selected.
+    returns number of repos to process"""
+    query, params = _get_candidates_query(db, providers, launch_limit, since)
+    names = list(CANDIDATE_COLUMNS)[1:]
+    max_id = db.conn.execute(f"SELECT max(id) FROM {repo_table};").fetchone()[0] or 0
+    with db.conn:
+        for table in [delta_table, refresh_candidate_table]:
+            db.conn.execute(f"DROP TABLE IF EXISTS temp.{table};")
+        db.conn.execute(f"CREATE TEMP TABLE {delta_table} (id INTEGER PRIMARY KEY, {', '.join(names)});")
+        db.conn.execute(f"INSERT INTO {delta_table} ({', '.join(names)}) {query};", params)
+        db.conn.execute(f"CREATE INDEX temp.idx_{delta_table}_repo_url ON {delta_table} (repo_url);")
+        # remote_id of existing repos is kept to update renamed of their old remote_id
+        db.conn.execute(f"CREATE TEMP TABLE {refresh_candidate_table} "
+                        f"(id INTEGER PRIMARY KEY, {', '.join(names)}, remote_id);")
+        if changed:
+            db.conn.execute(f"""INSERT INTO {refresh_candidate_table} 
+                                SELECT r.id, {', '.join(f'd.{n}' for n in names)}, r.remote_id 
+                                FROM {delta_table} AS d JOIN {repo_table} AS r ON r.repo_url = d.repo_url 
+                                WHERE r.last_launch_ts IS NOT d.last_launch_ts OR r.last_spec IS NOT d.last_spec;""")
+        # new repos are numbered in order of first launch (ids of delta table) and get ids after the last repo
+        db.conn.execute(f"DROP TABLE IF EXISTS temp.{repo_table}_new;")
+        db.conn.execute(f"CREATE TEMP TABLE {repo_table}_new (id INTEGER PRIMARY KEY, delta_id INTEGER);")
+        db.conn.execute(f"""INSERT INTO {repo_table}_new (delta_id) 
+                            SELECT id FROM {delta_table} 
+                            WHERE repo_url NOT IN (SELECT repo_url FROM {repo_table}) 
+                            ORDER BY id;""")
+        db.conn.execute(f"""INSERT INTO {refresh_candidate_table} 
+                            SELECT {max_id} + n.id, {', '.join(f'd.{n}' for n in names)}, NULL 
+                            FROM {repo_table}_new AS n JOIN {delta_table} AS d ON d.id = n.delta_id;""")
+        db.conn.execute(f"DROP TABLE temp.{repo_table}_new;")
+    return db.conn.execute(f"SELECT count(*) FROM {refresh_candidate_table};").fetchone()[0]
+
+
+def update_launch_data(db):
+    """updates launch count, first and last launch and last spec of existing repos in delta table"""
+    columns = list(CANDIDATE_COLUMNS)[3:]
+    with db.conn:
+        db.conn.execute(f"""UPDATE {repo_table} 
+                            SET ({', '.join(columns)}) = (SELECT {', '.join(columns)} FROM {delta_table} AS d 
+                                                          WHERE d.repo_url = {repo_table}.repo_url) 
+                            WHERE repo_url IN (SELECT repo_url FROM {delta_table});""")
+
+
+def get_last_refresh(db):
+    """returns watermark (ingested_until) of the last complete run or None"""
+    if refresh_table not in db.table_names():
+        return None
+    row = db.conn.execute(f"SELECT ingested_until FROM {refresh_table} WHERE refreshed_at IS NOT NULL "
+                          f"ORDER BY refreshed_at DESC, rowid DESC LIMIT 1;").fetchone()
+    return row[0] if row else None
+
+
+def set_renamed(db, remote_ids_query=None):
+    """detects renamed repos (rows with same remote id)
+    and sets renamed to 0 or to number of time that repo is named,
+    for non-existing repos it will stay as None (default).
+    if remote_ids_query is given, only repos with these remote ids are updated"""
+    db.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{repo_table}_remote_id ON {repo_table} (remote_id, provider);")
+    where = f"AND remote_id IN ({remote_ids_query})" if remote_ids_query else ""
+    # repos are counted per remote id once with a grouped query,
+    # then each repo is updated with a primary key search in the counts
+    renamed_table = f"{repo_table}_renamed"
+    with db.conn:
+        db.conn.execute(f"DROP TABLE IF EXISTS temp.{renamed_table};")
+        db.conn.execute(f"CREATE TEMP TABLE {renamed_table} "
+                        f"(remote_id, provider, renamed INTEGER, PRIMARY KEY (remote_id, provider)) WITHOUT ROWID;")
+        db.conn.execute(f"""INSERT INTO {renamed_table} 
+                            SELECT remote_id, provider, COUNT(*)-1 FROM {repo_table} 
+                            WHERE remote_id IS NOT null {where} 
+                            GROUP BY remote_id, provider;""")
+        db.conn.execute(f"""UPDATE {repo_table} SET renamed=(SELECT renamed 
+                                                     FROM {renamed_table} as r 
+                                                     WHERE r.remote_id={repo_table}.remote_id AND 
+                                                           r.provider={repo_table}.provider) 
+                            WHERE remote_id IS NOT null {where};""")
+        db.conn.execute(f"DROP TABLE temp.{renamed_table};")
+
+
+def _log_repo_id_progress(rowid, max_rowid):
+    msg = f"repo_id of launches is set until rowid {rowid}/{max_rowid}"
+    logger.info(msg)
+    if verbose:
+        print(msg)
+
+
+def get_repo_candidates(db, last_id=0, chunk_size=5000, table=candidate_table):
+    """returns iterator of repo candidates after last_id in chunks of DataFrames"""
+    # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_sql_query.html
+    query = f"SELECT * FROM {table} WHERE id > ? ORDER BY id;"
+    return pd.read_sql_query(query, db.conn, params=(last_id, ), chunksize=chunk_size)
+
+
+def _iter_candidates(db, last_id=0, table=candidate_table):
+    for df_chunk in get_repo_candidates(db, last_id, table=table):
+        for _, row in df_chunk.iterrows():
+            yield row
+
+
+def _new_repo_entry(row, columns):
+    repo_entry = {
+        # internal id
+        "id": int(row["id"]),
+        "remote_id": None,
+        "provider": row["provider"],
+        "repo_url": row["repo_url"],
+        "first_launch_ts": row["first_launch_ts"],
+        "last_launch_ts": row["last_launch_ts"],
+        # use spec of the last launch for resolved_ref
+        "last_spec": row["last_spec"],
+        "ref": None,
+        "resolved_ref": None,
+        "resolved_date": None,
+        "resolved_ref_date": None,
+        "fork": None,
+        "renamed": None,
+        "launch_count": row["launch_count"],
+        "binder_dir": None,
+        "buildpack": None,
+        "default_branch": None,
+        }
+    assert list(repo_entry.keys()) == list(columns.keys())
+    return repo_entry
+
+
+def get_repos_data_from_graphql(repo_entries, token_pool, api_url=GITHUB_API_URL):
+    """sets remote_id, fork and default_branch of GitHub repos with one GraphQL request.
+    repos, which are not resolved here, are fetched with REST API in get_repo_data"""
+    github_entries = {e["repo_url"]: e for e in repo_entries if e["provider"] == "GitHub"}
+    if not github_entries:
+        return
+    retry = 3
+    while retry:
+        try:
+            repos_data = get_repos_data_from_github_graphql(list(github_entries), api_url=api_url,
+                                                            token_pool=token_pool)
+        except RateLimitExceededException:
+            # token is marked as exhausted in the pool,
+            # next request waits only if all tokens are exhausted
+            logger.info(f'GraphQL: Rate limit error, will try again')
+            continue
+        except Exception:
+            logger.exception(f'Error while fetching {len(github_entries)} repos with GraphQL, attempt {4 - retry}')
+        else:
+            for repo_url, repo_data in repos_data.items():
+                github_entries[repo_url].update(repo_data)
+            return
+        sleep(retry ** retry)
+        retry -= 1
 
 
-def get_repo_data(repo_entry, access_token):
+def get_repo_data(repo_entry, token_pool, blobless=False, repo_cache=None, api_url=GITHUB_API_URL,
+                  response_cache=None, git=True):
+    """fetches repo data from API and, if git is True, from git.
+    with git=False, git data is collected by the git engine"""
+    # repo might be already fetched in a GraphQL batch
+    fetched = repo_entry["fork"] is not None
     retry = 3
     while retry:
         try:
-            repo_data = get_repo_data_from_github_api(repo_entry["provider"], repo_entry["repo_url"], access_token)
-            repo_entry.update(repo_data)
+            if not fetched:
+                repo_data = get_repo_data_from_github_api(repo_entry["provider"], repo_entry["repo_url"],
+                                                          api_url=api_url, token_pool=token_pool,
+                                                          response_cache=response_cache)
+                repo_entry.update(repo_data)
             ref = get_ref(repo_entry["provider"], repo_entry["last_spec"])
             repo_entry["ref"] = ref
-            if repo_entry["fork"] in [0, 1]:
-                repo_data = get_repo_data_from_git(ref, repo_entry["repo_url"])
+            if git and repo_entry["fork"] in [0, 1]:
+                repo_data = get_repo_data_from_git(ref, repo_entry["repo_url"], blobless, repo_cache)
                 repo_entry.update(repo_data)
+        except RateLimitExceededException:
+            # https://developer.github.com/v3/#rate-limiting
+            # token is marked as exhausted in the shared pool, so workers dont sleep independently,
+            # next request waits only if all tokens are exhausted and only until the earliest reset
+            logger.info(f'{repo_entry["repo_url"]}: Rate limit error, will try again')
+            # continue to process last repo again
+            continue
         except GithubException as e:
-            if e.status == 403:
-                # github.GithubException.RateLimitExceededException: 403
-                # https://developer.github.com/v3/#rate-limiting
-                minutes_until_reset = e.data["minutes_until_reset"]
-                minutes_until_reset = int(minutes_until_reset/2)
-                msg = f'{repo_entry["repo_url"]}: Rate limit error, will try again after sleeping {minutes_until_reset} minutes'
-                logger.info(msg)
-                if verbose:
-                    print(msg)
-                sleep(minutes_until_reset * 60)
-                # continue to process last repo again
-                continue
-            else:
-                repo_entry["fork"] = e.status
-                logger.info(f'Error while processing {repo_entry["repo_url"]}, attempt {4 - retry}')
-                logger.exception(f'{repo_entry["repo_url"]}')
-                sleep(retry ** retry)
-                retry -= 1
-                continue
+            # e.g. blocked (451) or forbidden (403) repos
+            repo_entry["fork"] = e.status
+            logger.info(f'Error while processing {repo_entry["repo_url"]}, attempt {4 - retry}')
+            logger.exception(f'{repo_entry["repo_url"]}')
+            sleep(retry ** retry)
+            retry -= 1
+            continue
         except Exception as e:
             logger.info(f'Error while processing {repo_entry["repo_url"]}, attempt {4 - retry}')
             logger.exception(f'{repo_entry["repo_url"]}')
@@ -88,19 +318,18 @@ def get_repo_data(repo_entry, access_token):
     return repo_entry
 
 
-def create_repo_table(db_name, providers, launch_limit, access_token=None, max_workers=4):
+def create_repo_table(db_name, providers, launch_limit, access_token=None, max_workers=4, resume=False,
+                      blobless=False, repo_cache=None, graphql=False, api_url=GITHUB_API_URL, response_cache=None,
+                      incremental=False, git_concurrency=0, host_concurrency=DEFAULT_HOST_CONCURRENCY):
     start_time = datetime.now()
-    msg = f"creating repo table, started at {start_time}"
+    msg = f"{'refreshing' if incremental else 'creating'} repo table, started at {start_time}"
     if verbose:
         print(msg)
     logger.info(msg)
 
     db = Database(db_name)
-    if repo_table in db.table_names():
-        raise Exception(f"table {repo_table} already exists in {db_name}")
-    else:
-        # create repo table with id column as primary key
-        columns = {
+    # columns of repo table
+    columns = {
                 "id": int,
                 # there will be repos with same remote_id, because they are renamed
                 "remote_id": str,
@@ -120,131 +349,200 @@ def create_repo_table(db_name, providers, launch_limit, access_token=None, max_w
                 "launch_count": int,
                 "binder_dir": str,
                 "buildpack": str,
+                "default_branch": str,
             }
+    # id of the last saved repo
+    last_id = 0
+    # table of repos to process
+    table = candidate_table
+    # in incremental mode only new repos and repos with new launches are processed
+    refresh = False
+    if refresh_table not in db.table_names():
+        db[refresh_table].create(REFRESH_COLUMNS)
+    if repo_table in db.table_names():
+        if incremental:
+            if candidate_table in db.table_names():
+                raise Exception(f"table {repo_table} is not complete in {db_name}, "
+                                f"its creation must be continued with --resume")
+            refresh = True
+            table = refresh_candidate_table
+            since = get_last_refresh(db)
+            with db.conn:
+                # archive days, which are saved from now on, are processed in the next refresh
+                db.conn.execute(f"DELETE FROM {refresh_table} WHERE refreshed_at IS NULL;")
+                db[refresh_table].insert({"refreshed_at": None, "ingested_until": get_ingested_until(db)})
+            # without access token repo data is not fetched, so only new repos are processed
+            count = create_refresh_candidates(db, providers, launch_limit, since, changed=bool(access_token))
+        elif not resume or candidate_table not in db.table_names():
+            raise Exception(f"table {repo_table} already exists in {db_name}")
+        else:
+            # continue after the last saved chunk of a previous run
+            last_id = db.conn.execute(f"SELECT max(id) FROM {repo_table};").fetchone()[0] or 0
+            count = db.conn.execute(f"SELECT count(*) FROM {candidate_table};").fetchone()[0]
+        if "default_branch" not in db[repo_table].columns_dict:
+            # repo table of an older version
+            db[repo_table].add_column("default_branch", str)
+    else:
+        with db.conn:
+            db.conn.execute(f"DELETE FROM {refresh_table} WHERE refreshed_at IS NULL;")
+            db[refresh_table].insert({"refreshed_at": None, "ingested_until": get_ingested_until(db)})
+        count = create_repo_candidates(db, providers, launch_limit)
+        # create repo table with id column as primary key
         db[repo_table].create(
             columns,
             pk="id",
         )
-        repos = db[repo_table]
+    repos = db[repo_table]
 
-    repos_df_iter, count = get_repos_from_launch_table(db, providers, launch_limit)
     if verbose:
         msg = f"{count} repos will be processed"
+        if last_id:
+            msg += f", continuing after repo {last_id}"
         logger.info(msg)
         print(msg)
-    repo_count = 0
+    repo_count = db.conn.execute(f"SELECT count(*) FROM {table} WHERE id <= ?;", (last_id, )).fetchone()[0]
     jobs_done = 0
-    # internal id
-    id_ = 0
-    for df_chunk in repos_df_iter:
-        repos_list = []
-        rows = df_chunk.iterrows()
-        # with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            jobs = {}
-            index, row = next(rows)
-            while True:
-                if row is not None:
-                    id_ += 1
-                    # use spec of the last launch for resolved_ref
-                    ts_specs = [ts_spec.split(";") for ts_spec in row["ts_specs"].split(",")]
-                    # sort by first element, which is timestamp
-                    ts_specs = sorted(ts_specs, key=lambda x: x[0])
-                    last_spec = ts_specs[-1][1]
-                    repo_entry = {
-                        "id": id_,
-                        "remote_id": None,
-                        "provider": row["provider"],
-                        "repo_url": row["repo_url"],
-                        "first_launch_ts": row["first_launch_ts"],
-                        "last_launch_ts": row["last_launch_ts"],
-                        "last_spec": last_spec,
-                        "ref": None,
-                        "resolved_ref": None,
-                        "resolved_date": None,
-                        "resolved_ref_date": None,
-                        "fork": None,
-                        "renamed": None,
-                        "launch_count": row["launch_count"],
-                        "binder_dir": None,
-                        "buildpack": None,
-                        }
-                    assert list(repo_entry.keys()) == list(columns.keys())
-
+    # ids of repos in order, which are not saved yet
+    order = deque()
+    # finished repos, which wait for repos with lower ids: {id: repo_entry or None if job failed}
+    finished = {}
+    # repos to save, in order of ids
+    repos_list = []
+    # {job: repo_entry}
+    jobs = {}
+    # jobs of git engine, {job: repo_entry}
+    git_jobs = {}
+    rows = _iter_candidates(db, last_id, table)
+    token_pool = None
+    if access_token:
+        # rate limit budget of all tokens is shared by workers
+        manager, token_pool = start_token_pool(access_token.split(","))
+    # with GraphQL metadata of repos is fetched in batches before the jobs
+    batch_size = GRAPHQL_BATCH_SIZE if access_token and graphql else 1
+    git_engine = None
+    if access_token and git_concurrency:
+        # processes do only API requests, repos are cloned concurrently by asyncio subprocesses
+        git_engine = GitEngine(git_concurrency, host_concurrency, detect_workers=max_workers, logger=logger)
+    # one pool for all repos, it is fed continuously and
+    # results are saved as they complete, so a slow repo doesnt block a whole chunk
+    # with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        row = next(rows, None)
+        while row is not None or jobs or git_jobs:
+            # limit number of jobs in flight and number of repos waiting for a slower repo,
+            # so memory usage stays constant
+            while row is not None and len(jobs) < max_workers * 2 and len(order) < REORDER_WINDOW:
+                repo_entries = []
+                while row is not None and len(repo_entries) < batch_size:
+                    repo_entries.append(_new_repo_entry(row, columns))
+                    row = next(rows, None)
+                if batch_size > 1:
+                    get_repos_data_from_graphql(repo_entries, token_pool, api_url)
+                for repo_entry in repo_entries:
+                    order.append(repo_entry["id"])
                     if access_token:
-                        job = executor.submit(get_repo_data, repo_entry, access_token)
-                        jobs[job] = f'{id_}:{row["repo_url"]}'
+                        job = executor.submit(get_repo_data, repo_entry, token_pool, blobless, repo_cache, api_url,
+                                              response_cache, git_engine is None)
+                        jobs[job] = repo_entry
                     else:
-                        repos_list.append(repo_entry)
+                        finished[repo_entry["id"]] = repo_entry
+            if git_engine is not None and not git_engine.running:
+                # workers of the pool are forked by now, forking while the loop thread runs is not safe
+                git_engine.start()
 
-                if (jobs and len(jobs) == max_workers) or row is None:
-                    # limit number of jobs with max_workers
-                    # row is None means there is no new job
-                    for job in as_completed(jobs):
-                        id_repo_url = jobs[job]
+            if jobs or git_jobs:
+                done, _ = wait(list(jobs) + list(git_jobs), return_when=FIRST_COMPLETED)
+                for job in done:
+                    if job in git_jobs:
+                        repo_entry = git_jobs.pop(job)
                         try:
-                            r = job.result()
-                            repos_list.append(r)
-                            jobs_done += 1
-                        except Exception as exc:
-                            logger.exception(f"{id_repo_url}")
-
-                        del jobs[job]
-                        # break to add a new job, if there is any
-                        break
-
-                try:
-                    # get next row
-                    index, row = next(rows)
-                except StopIteration:
-                    # chunk is finished
-                    if not jobs:
-                        # process next chunk
-                        break
-                    # wait until all jobs finish
-                    row = None
-
-        repos.insert_all(repos_list, pk="id", columns=columns)
-        repo_count += len(df_chunk)
-        msg = f"{repo_count} ({jobs_done}) repos are processed"
-        logger.info(msg)
-        if verbose:
-            print(msg)
-        # print(df_chunk.dtypes)
+                            repo_entry.update(job.result())
+                        except Exception:
+                            # all attempts failed, repo is saved with its API data as in get_repo_data
+                            logger.info(f'{repo_entry["id"]}:{repo_entry["repo_url"]}: git data is not collected')
+                        finished[repo_entry["id"]] = repo_entry
+                        jobs_done += 1
+                        continue
+                    repo_entry = jobs.pop(job)
+                    try:
+                        repo_entry = job.result()
+                    except Exception as exc:
+                        logger.exception(f'{repo_entry["id"]}:{repo_entry["repo_url"]}')
+                        finished[repo_entry["id"]] = None
+                        continue
+                    if git_engine is not None and repo_entry["fork"] in [0, 1]:
+                        job = git_engine.submit(repo_entry["ref"], repo_entry["repo_url"], blobless, repo_cache)
+                        git_jobs[job] = repo_entry
+                    else:
+                        finished[repo_entry["id"]] = repo_entry
+                        jobs_done += 1
+
+            # repos are saved in order of ids, independent of completion order,
+            # so an interrupted run can be resumed after the last saved id
+            while order and order[0] in finished:
+                repo_entry = finished.pop(order.popleft())
+                repo_count += 1
+                if repo_entry is not None:
+                    repos_list.append(repo_entry)
+            if len(repos_list) >= WRITE_BATCH_SIZE or (row is None and not jobs and not git_jobs):
+                if refresh:
+                    # existing repos are replaced
+                    repos.upsert_all(repos_list, pk="id", columns=columns)
+                else:
+                    repos.insert_all(repos_list, pk="id", columns=columns)
+                repos_list = []
+                msg = f"{repo_count}/{count} ({jobs_done}) repos are processed"
+                if token_pool is not None:
+                    msg += f", remaining rate limit: {token_pool.get_remaining()}"
+                logger.info(msg)
+                if verbose:
+                    print(msg)
+    if git_engine is not None:
+        git_engine.stop()
+
+    if refresh:
+        # launch data of the other repos with new launches, processed repos are already up to date
+        update_launch_data(db)
 
     if access_token:
+        manager.shutdown()
         if verbose:
             print("Detecting renamed repos")
         logger.info("Detecting renamed repos")
-        # detect renamed repos (rows with same remote id)
-        # and set renamed to 0 or to number of time that repo is named
-        # for non-existing repos it will stay as None (default)
-        db.conn.execute(f"""UPDATE {repo_table} SET renamed=(SELECT COUNT(remote_id)-1 
-                                                     FROM {repo_table} as r 
-                                                     WHERE r.remote_id={repo_table}.remote_id AND 
-                                                           r.provider={repo_table}.provider) 
-                            WHERE remote_id IS NOT null;""")
-        db.conn.commit()
+        if refresh:
+            # only current and old remote ids of repos with new launches
+            set_renamed(db, f"SELECT remote_id FROM {repo_table} WHERE repo_url IN (SELECT repo_url FROM {delta_table}) "
+                            f"UNION SELECT remote_id FROM {refresh_candidate_table}")
+        else:
+            set_renamed(db)
 
         # add repo_id fk into launch table
         if verbose:
             print("Adding repo_id fk into launch table")
         logger.info("Adding repo_id fk into launch table")
-        if "repo_id" not in db[launch_table].columns_dict:
-            db[launch_table].add_column("repo_id", fk=repo_table, fk_col="id")
-        db.conn.execute(f"""UPDATE {launch_table}
-                            SET repo_id=(SELECT id
-                                         FROM {repo_table}
-                                         WHERE repo_url={launch_table}.repo_url);""")
-        db.conn.commit()
-
-    # optimize the database
-    if verbose:
-        print("Vacuum")
-    logger.info("Vacuum")
-    db.vacuum()
+        set_launch_repo_ids(db, repo_table, only_missing=refresh, progress=_log_repo_id_progress)
+
+    with db.conn:
+        db.conn.execute(f"UPDATE {refresh_table} SET refreshed_at=? WHERE refreshed_at IS NULL;",
+                        (datetime.utcnow().replace(microsecond=0).isoformat(), ))
+    if refresh:
+        for t in [delta_table, refresh_candidate_table]:
+            db.conn.execute(f"DROP TABLE temp.{t};")
+    else:
+        # repo table is complete, candidates are not needed anymore
+        db[candidate_table].drop()
+
+        # optimize the database
+        # skip it in incremental mode, vacuum of a large database takes long
+        if verbose:
+            print("Vacuum")
+        logger.info("Vacuum")
+        db.vacuum()
     end_time = datetime.now()
-    msg = f"repo table is created with {repo_count} ({count}) entries"
+    if refresh:
+        msg = f"repo table is refreshed, {repo_count} ({count}) new or changed repos are processed"
+    else:
+        msg = f"repo table is created with {repo_count} ({count}) entries"
     msg += f"\nduration: {end_time - start_time}"
     if verbose:
         print(f"finished at {end_time}")
@@ -262,7 +560,8 @@ def get_args():
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-n', '--db_name', required=True)
     parser.add_argument('-t', '--access_token', required=False,
-                        help='Access token for GitHub API. If access token is not provided, '
+                        help='Access token for GitHub API, or comma-separated list of tokens, '
+                             'which are used round-robin. If access token is not provided, '
                              'these additional data will not be fetched: '
                              '`fork`, `remote_id`, `resolved_ref`, `buildpack`, `renamed`...\n'
                              'Without authentication GitHub API allows 60 requests per hour, '
@@ -277,6 +576,43 @@ def get_args():
                              'Default is 0, which means save all repos.')
     parser.add_argument('-m', '--max_workers', type=int, default=4, help='Max number of processes to run in parallel. '
                                                                          'Default is 4.')
+    parser.add_argument('-r', '--resume', required=False, default=False, action='store_true',
+                        help=f'Continue an interrupted run, `{repo_table}` table is completed with the remaining repos '
+                             f'of `{candidate_table}` table. Default is False.')
+    parser.add_argument('-i', '--incremental', required=False, default=False, action='store_true',
+                        help=f'Refresh an existing `{repo_table}` table after new archive days are parsed: '
+                             f'only new repos and repos whose last launch or last spec changed '
+                             f'since the last run are processed, launch counts of other repos with new launches '
+                             f'are updated. Default is False.')
+    parser.add_argument('-b', '--blobless', required=False, default=False, action='store_true',
+                        help='Clone repos without file contents and check out only the files which are needed to '
+                             'detect the buildpack. This is faster for large repos and '
+                             'gives the same result as a full clone. Default is False.')
+    parser.add_argument('-c', '--repo_cache', required=False, default=None,
+                        help='Folder of local mirrors of repos (see repo_cache.py). If it is given, repos are cloned '
+                             'from their mirrors and only new commits are fetched from remote.')
+    parser.add_argument('-cs', '--repo_cache_size', type=float, default=DEFAULT_MAX_SIZE_GB,
+                        help=f'Disk budget of repo cache in GB, least recently used mirrors are removed. '
+                             f'Default is {DEFAULT_MAX_SIZE_GB}.')
+    parser.add_argument('-g', '--graphql', required=False, default=False, action='store_true',
+                        help=f'Fetch remote_id, fork and default_branch of GitHub repos with GraphQL API '
+                             f'in batches of {GRAPHQL_BATCH_SIZE} repos, which costs 1 point of rate limit per batch '
+                             f'instead of 1 point per repo. Default is False.')
+    parser.add_argument('-gc', '--git_concurrency', type=int, default=0,
+                        help='Number of repos which are cloned concurrently with asyncio subprocesses in one process, '
+                             'then worker processes (--max_workers) only fetch API data. '
+                             'This is useful when most of the time is spent waiting for clones. '
+                             'Default is 0, which means repos are cloned in worker processes.')
+    parser.add_argument('-hc', '--host_concurrency', type=int, default=DEFAULT_HOST_CONCURRENCY,
+                        help=f'Max number of concurrent clones from the same host with --git_concurrency. '
+                             f'Default is {DEFAULT_HOST_CONCURRENCY}.')
+    parser.add_argument('--response_cache', required=False, default=None,
+                        help='Sqlite database of cached GitHub API responses (see response_cache.py). '
+                             'If it is given, repos which are fetched in a previous run are revalidated with '
+                             'conditional requests, which don\'t count against the rate limit '
+                             'when repo is not modified.')
+    parser.add_argument('--github_api_url', required=False, default=GITHUB_API_URL,
+                        help=f'Default is {GITHUB_API_URL}. To test with a local stub, see github_api_stub.py.')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
                         help='Default is False.')
     args = parser.parse_args()
@@ -298,6 +634,8 @@ def main():
         access_token = None
         print("No token for GitHub API, no additional data will be fetched from GitHub API.")
     max_workers = args.max_workers
+    repo_cache = RepoCache(args.repo_cache, args.repo_cache_size) if args.repo_cache else None
+    response_cache = ResponseCache(args.response_cache) if args.response_cache else None
     verbose = args.verbose
 
     _, script_ts_safe = get_utc_ts()
@@ -306,7 +644,9 @@ def main():
     if verbose:
         print(f"Logs are in {logger_name}.log")
 
-    create_repo_table(db_name, providers, launch_limit, access_token, max_workers)
+    create_repo_table(db_name, providers, launch_limit, access_token, max_workers, args.resume, args.blobless,
+                      repo_cache, args.graphql, args.github_api_url, response_cache, args.incremental,
+                      args.git_concurrency, args.host_concurrency)
     print(f"""\n
     Repo data is extracted from `{launch_table}` table and saved into `{repo_table}` table.
     You can open this database with `sqlite3 {db_name}` command and then run any sqlite3 command, 
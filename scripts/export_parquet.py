@@ -0,0 +1,187 @@
+"""
+Script to export launch and repo tables into parquet files partitioned by month.
+"""
+import os
+import json
+import shutil
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime
+from sqlite_utils import Database
+from launch_db import get_manifest, get_launches_of_day_query, launch_table_exists, LAUNCH_COLUMNS
+from utils import get_logger, get_utc_ts, check_if_exists, LAUNCH_TABLE as launch_table, REPO_TABLE as repo_table
+
+DEFAULT_OUTPUT_DIR = "parquet"
+# file to keep checksums of exported archive days
+EXPORT_STATE_FILE = "_exported.json"
+# key of schema of exported launches in state file
+SCHEMA_KEY = "_schema"
+
+# text columns with few distinct values, they are dictionary-encoded in parquet files
+LAUNCH_CATEGORY_COLUMNS = ["origin", "provider", "org", "r2d_version", "repo_url"]
+REPO_CATEGORY_COLUMNS = ["provider", "binder_dir", "buildpack"]
+# arrow types of column types of sqlite tables
+ARROW_TYPES = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+# same index type in all files, otherwise a dataset of files with different number of categories can't be read
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+
+def _get_schema(columns, category_columns):
+    """returns arrow schema of {column: type}, all files of a table are written with the same schema,
+    e.g. a column without values in a file is not null typed"""
+    return pa.schema([(column, CATEGORY_TYPE if column in category_columns else ARROW_TYPES.get(type_, pa.string()))
+                      for column, type_ in columns.items()])
+
+
+LAUNCH_SCHEMA = _get_schema(LAUNCH_COLUMNS, LAUNCH_CATEGORY_COLUMNS)
+
+
+def _to_categories(df, columns):
+    for column in columns:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def export_launches_of_day(db, archive_date, output_dir):
+    """writes launches of an archive day into <output_dir>/mybinderlaunch/month=<YYYY-MM>/<YYYY-MM-DD>.parquet
+    returns number of exported launches"""
+    query, params = get_launches_of_day_query(db, archive_date)
+    df = pd.read_sql_query(query, db.conn, params=params)
+    month_dir = os.path.join(output_dir, launch_table, f"month={archive_date[:7]}")
+    file_path = os.path.join(month_dir, f"{archive_date}.parquet")
+    if len(df) == 0:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return 0
+    os.makedirs(month_dir, exist_ok=True)
+    df = _to_categories(df, LAUNCH_CATEGORY_COLUMNS)
+    table = pa.Table.from_pandas(df, schema=LAUNCH_SCHEMA, preserve_index=False)
+    # write into a temp file first, so readers never see a partial file.
+    # files starting with "_" are ignored by parquet readers
+    tmp_path = os.path.join(month_dir, f"_{archive_date}.parquet.tmp")
+    pq.write_table(table, tmp_path, use_dictionary=True, compression="snappy")
+    os.replace(tmp_path, file_path)
+    return len(df)
+
+
+def export_repos(db, output_dir):
+    """writes repo table into <output_dir>/repo/month=<YYYY-MM of first launch>/, repo table is always fully exported"""
+    repo_dir = os.path.join(output_dir, repo_table)
+    if os.path.exists(repo_dir):
+        shutil.rmtree(repo_dir)
+    df = pd.read_sql_query(f"SELECT * FROM {repo_table};", db.conn)
+    if len(df) == 0:
+        return 0
+    df["month"] = df["first_launch_ts"].str[:7]
+    df = _to_categories(df, REPO_CATEGORY_COLUMNS)
+    schema = _get_schema({**db[repo_table].columns_dict, "month": str}, REPO_CATEGORY_COLUMNS)
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    pq.write_to_dataset(table, repo_dir, partition_cols=["month"], use_dictionary=True, compression="snappy")
+    return len(df)
+
+
+def export_parquet(db_name, output_dir):
+    start_time = datetime.now()
+    msg = f"export started at {start_time}"
+    if verbose:
+        print(msg)
+    logger.info(msg)
+
+    db = Database(db_name)
+    if not launch_table_exists(db):
+        raise Exception(f"table {launch_table} doesnt exist in {db_name}")
+    os.makedirs(output_dir, exist_ok=True)
+    state_file = os.path.join(output_dir, EXPORT_STATE_FILE)
+    try:
+        with open(state_file, "r") as f:
+            exported = json.load(f)
+    except FileNotFoundError:
+        exported = {}
+    schema = [f"{field.name}: {field.type}" for field in LAUNCH_SCHEMA]
+    if exported and exported.get(SCHEMA_KEY) != schema:
+        # files of an older export have another schema (e.g. repo_id column or other index types of categories),
+        # all days are exported again, so all files have the same schema
+        exported = {}
+    exported[SCHEMA_KEY] = schema
+
+    # export only days which are changed since the last export
+    day_count = 0
+    launch_count = 0
+    for archive_date, entry in sorted(get_manifest(db).items()):
+        if entry["status"] != "done" or exported.get(archive_date) == entry["checksum"]:
+            continue
+        count = export_launches_of_day(db, archive_date, output_dir)
+        exported[archive_date] = entry["checksum"]
+        # save state after each day, so an interrupted export continues from there
+        with open(state_file, "w") as f:
+            json.dump(exported, f, indent=1, sort_keys=True)
+        day_count += 1
+        launch_count += count
+        msg = f"{archive_date}: {count} launches"
+        if verbose:
+            print(msg)
+        logger.info(msg)
+    msg = f"{launch_count} launches of {day_count} days are exported"
+    if verbose:
+        print(msg)
+    logger.info(msg)
+
+    if repo_table in db.table_names():
+        count = export_repos(db, output_dir)
+        msg = f"{count} repos are exported"
+        if verbose:
+            print(msg)
+        logger.info(msg)
+
+    end_time = datetime.now()
+    msg = f"duration: {end_time - start_time}"
+    if verbose:
+        print(f"export finished at {end_time}")
+        print(msg)
+    logger.info(msg)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=f'This script exports `{launch_table}` and `{repo_table}` tables '
+                                                 f'into parquet files partitioned by month. '
+                                                 f'Launches are exported per archive day and only days which are '
+                                                 f'new or changed since the last export are written again.'
+                                                 f'\nExample command to export example.db: '
+                                                 f'\n\tpython export_parquet.py -v -n example.db',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--db_name', required=True)
+    parser.add_argument('-o', '--output_dir', required=False, default=DEFAULT_OUTPUT_DIR,
+                        help=f'Folder to write parquet files. Default is {DEFAULT_OUTPUT_DIR}.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='Default is False.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    global verbose
+    global logger
+
+    args = get_args()
+    db_name = args.db_name
+    check_if_exists(db_name)
+    verbose = args.verbose
+
+    _, script_ts_safe = get_utc_ts()
+    logger_name = f'{os.path.basename(__file__)[:-3]}_at_{script_ts_safe}'.replace("-", "_")
+    logger = get_logger(logger_name)
+    if verbose:
+        print(f"Logs are in {logger_name}.log")
+
+    export_parquet(db_name, args.output_dir)
+    print(f"""\n
+    `{launch_table}` and `{repo_table}` tables of {db_name} are exported into {args.output_dir}.
+    You can load them with `analysis/parquet_loader.py`.
+    """)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Script to generate synthetic mybinder.org events archive files (events-<date>.jsonl), e.g. for benchmarks.
+
+Generated archives have the same format and quirks as the real archive (https://archive.analytics.mybinder.org/):
+- events before 12.06.2019 have no origin and events of 12.06.2019 are mixed
+- events before 18.06.2020 have no (resolved) ref and events of 18.06.2020 are mixed
+- malformed specs, which are fixed in parse_mybinder_archive._handle_exceptions_in_archve, are in their archives
+"""
+import os
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# share of launches per provider, roughly as in the real archive
+PROVIDER_WEIGHTS = {
+    "GitHub": 0.92,
+    "Gist": 0.03,
+    "GitLab": 0.02,
+    "Git": 0.015,
+    "Zenodo": 0.008,
+    "Figshare": 0.003,
+    "Hydroshare": 0.002,
+    "Dataverse": 0.002,
+}
+
+ORIGIN_WEIGHTS = {
+    "gke.mybinder.org": 0.6,
+    "ovh.mybinder.org": 0.2,
+    "gesis.mybinder.org": 0.15,
+    "turing.mybinder.org": 0.05,
+}
+
+# malformed specs in the real archive, see parse_mybinder_archive._handle_exceptions_in_archve
+MALFORMED_SPECS = {
+    "2018-11-25": ("GitHub", "https%3A%2F%2Fgist.github.com%2Fjakevdp/256c3ad937af9ec7d4c65a29e5b6d454"),
+    "2019-01-28": ("Gist", "loicmarie/ade5ea460444ea0ff72d5c94daa14500"),
+    "2019-02-22": ("Gist", "minrk/6d61e5edfa4d2947b0ee8c1be8e79154"),
+    "2019-03-05": ("Gist", "vingkan/25c74b0e1ea87110a740a9c29a901200"),
+    "2019-03-07": ("Gist", "bitnik/2b5b3ad303859663b222fa5a6c2d3726"),
+}
+
+# dates when origin and ref are added to events
+ORIGIN_DATE = "2019-06-12"
+REF_DATE = "2020-06-18"
+
+DEFAULT_OUTPUT_DIR = "synthetic_archive"
+R2D_HISTORY_FILE = "r2d_history.json"
+
+
+def _sha(rng, length=40):
+    return "".join(rng.choice("0123456789abcdef") for _ in range(length))
+
+
+def _generate_spec(rng, provider, i):
+    """returns spec of the i-th repo of the provider, with variations seen in the real archive"""
+    if provider == "GitHub":
+        org, repo = f"org{i % 997}", f"repo{i}"
+        variation = rng.random()
+        if variation < 0.05:
+            # same repo with different case and ".git" suffix
+            org, repo = org.capitalize(), f"{repo}.git"
+        ref = rng.choice(["master"] * 8 + ["main", "HEAD", "v1.0", "master/", _sha(rng)])
+        return f"{org}/{repo}/{ref}"
+    elif provider == "Gist":
+        gist_id = _sha(rng, 32)
+        # "user/gist_id" and "user/gist_id/master/master" are valid specs too
+        ref = rng.choice(["/master"] * 6 + ["", "/master/master", f"/{_sha(rng)}"])
+        return f"user{i % 101}/{gist_id}{ref}"
+    elif provider == "GitLab":
+        return f"group{i % 53}%2Fproject{i}/{rng.choice(['master', 'main', _sha(rng)])}"
+    elif provider == "Git":
+        return f"https%3A%2F%2Fgit.example.org%2Fuser{i % 31}%2Frepo{i}.git/{_sha(rng)}"
+    elif provider == "Zenodo":
+        return f"10.5281/zenodo.{3000000 + i}"
+    elif provider == "Figshare":
+        return f"10.6084/m9.figshare.{9000000 + i}.v1"
+    elif provider == "Hydroshare":
+        return _sha(rng, 32)
+    elif provider == "Dataverse":
+        return f"10.7910/DVN/{_sha(rng, 6).upper()}"
+    raise Exception(f"unknown provider: {provider}")
+
+
+def generate_repos(rng, repo_count):
+    """returns (provider, spec) of repos and their cumulative weights,
+    popularity of repos follows a zipf-like distribution: a few repos have most of the launches"""
+    providers = rng.choices(list(PROVIDER_WEIGHTS), weights=list(PROVIDER_WEIGHTS.values()), k=repo_count)
+    repos = [(provider, _generate_spec(rng, provider, i)) for i, provider in enumerate(providers)]
+    cum_weights = []
+    total = 0
+    for i in range(repo_count):
+        total += 1 / (i + 1)
+        cum_weights.append(total)
+    return repos, cum_weights
+
+
+def generate_events(rng, archive_date, event_count, repos, cum_weights):
+    """returns events of an archive day, ordered by timestamp"""
+    date_str = str(archive_date)
+    minutes = sorted(rng.randrange(24 * 60) for _ in range(event_count))
+    launches = rng.choices(repos, cum_weights=cum_weights, k=event_count)
+    if date_str in MALFORMED_SPECS:
+        launches[rng.randrange(event_count)] = MALFORMED_SPECS[date_str]
+    origins = rng.choices(list(ORIGIN_WEIGHTS), weights=list(ORIGIN_WEIGHTS.values()), k=event_count)
+    # schema version of launch events
+    version = 1 if date_str < ORIGIN_DATE else 2 if date_str < REF_DATE else 3
+    events = []
+    for minute, (provider, spec), origin in zip(minutes, launches, origins):
+        event = {
+            "timestamp": f"{date_str}T{minute // 60:02d}:{minute % 60:02d}:00Z",
+            "schema": "binderhub.jupyter.org/launch",
+            "version": version,
+            "provider": provider,
+            "spec": spec,
+            "status": "success",
+        }
+        # events of the day when origin (or ref) is added have mixed rows
+        if date_str > ORIGIN_DATE or (date_str == ORIGIN_DATE and rng.random() < 0.5):
+            event["origin"] = origin
+        if date_str > REF_DATE or (date_str == REF_DATE and rng.random() < 0.5):
+            event["ref"] = _sha(rng)
+        events.append(event)
+    return events
+
+
+def generate_r2d_history(start_date, days):
+    """returns a repo2docker version history of mybinder.org (as utils.get_mybinder_repo2docker_history)
+    with a version change every 30 days"""
+    r2d_history = {}
+    for i, day in enumerate(range(0, days, 30)):
+        ts = datetime.combine(start_date + timedelta(days=day), datetime.min.time()).replace(hour=12)
+        r2d_history[ts.isoformat()] = {"commit": _sha(random.Random(i)),
+                                       "old": f"jupyter/repo2docker:0.{i}.0",
+                                       "new": f"jupyter/repo2docker:0.{i + 1}.0"}
+    return r2d_history
+
+
+def generate_archive(output_dir, start_date, days, events_per_day, repo_count, seed=0):
+    """writes archive files of given days into output_dir and r2d history of that period.
+    returns total number of events"""
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    repos, cum_weights = generate_repos(rng, repo_count)
+    total_events = 0
+    for day in range(days):
+        archive_date = start_date + timedelta(days=day)
+        # number of launches changes from day to day
+        event_count = max(1, int(rng.gauss(events_per_day, events_per_day * 0.1)))
+        events = generate_events(rng, archive_date, event_count, repos, cum_weights)
+        with open(os.path.join(output_dir, f"events-{archive_date}.jsonl"), "w") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+        total_events += event_count
+    with open(os.path.join(output_dir, R2D_HISTORY_FILE), "w") as f:
+        json.dump(generate_r2d_history(start_date, days), f, indent=1)
+    return total_events
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='This script generates synthetic mybinder.org events archive files '
+                                                 '(events-<date>.jsonl) with the same format and quirks as the '
+                                                 'real archive and the r2d version history of that period '
+                                                 f'({R2D_HISTORY_FILE}).'
+                                                 '\nExample command to generate 10 days with 100000 events per day: '
+                                                 '\n\tpython generate_archive.py -s 2020-06-15 -d 10 -e 100000',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-o', '--output_dir', required=False, default=DEFAULT_OUTPUT_DIR,
+                        help=f'Default is {DEFAULT_OUTPUT_DIR}.')
+    parser.add_argument('-s', '--start_date', required=False, default="2019-06-10",
+                        help='Date of the first archive. In form of "YYYY-MM-DD". Default is 2019-06-10.')
+    parser.add_argument('-d', '--days', type=int, default=7, help='Number of archive days. Default is 7.')
+    parser.add_argument('-e', '--events_per_day', type=int, default=10000,
+                        help='Average number of events per day. Default is 10000.')
+    parser.add_argument('-r', '--repo_count', type=int, default=20000,
+                        help='Number of distinct repos. Default is 20000.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    start_date = datetime.strptime(args.start_date, '%Y-%m-%d').date()
+    total_events = generate_archive(args.output_dir, start_date, args.days, args.events_per_day,
+                                    args.repo_count, args.seed)
+    print(f"{total_events} events of {args.days} days are generated into {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
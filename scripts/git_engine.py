@@ -0,0 +1,220 @@
+"""
+Asyncio engine to collect repo data from git (same as utils.get_repo_data_from_git) for many repos at once.
+
+Git commands run as asyncio subprocesses, so hundreds of clones can wait for the network in one process,
+instead of one worker process per waiting clone. At most `concurrency` repos are processed at the same time
+and at most `host_concurrency` of them from the same host (e.g. github.com).
+Buildpack detection is CPU-bound and changes the working directory (repo2docker.utils.chdir),
+so it runs in a small process pool.
+Like archive_cache.ArchiveDownloader, the engine runs its loop in a background thread:
+
+    engine = GitEngine(concurrency=200, host_concurrency=50)
+    engine.start()
+    future = engine.submit(ref, repo_url, blobless)
+    repo_data = future.result()
+    engine.stop()
+
+Jobs are concurrent.futures.Future objects, so they can be waited together with jobs of a process pool.
+"""
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+from utils import detect_buildpack, detect_buildpack_from_tree, _parse_git_tree, _get_detect_paths, \
+    _is_unknown_ref_error, _to_utc_isoformat
+
+DEFAULT_CONCURRENCY = 100
+DEFAULT_HOST_CONCURRENCY = 20
+
+
+async def git_execute_async(command, cwd=None, env=None):
+    """same as utils.git_execute, but with an asyncio subprocess"""
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                   cwd=cwd, env=env)
+    stdout, stderr = await process.communicate()
+    result = subprocess.CompletedProcess(command, process.returncode, stdout.decode(), stderr.decode())
+    if result.returncode:
+        raise Exception(f"{command}: {result.stderr}")
+    return result
+
+
+async def resolve_ref_async(ref, repo_dir):
+    """same as utils.resolve_ref"""
+    for rev in [ref, f"origin/{ref}"]:
+        command = ["git", "rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"]
+        try:
+            result = await git_execute_async(command, repo_dir)
+        except Exception:
+            continue
+        return result.stdout.strip()
+    return None
+
+
+async def _clone(repo_url, tmp_dir_path, blobless, repo_cache):
+    loop = asyncio.get_event_loop()
+    if repo_cache is not None:
+        # locking and fetching into the mirror blocks, so it runs in a thread,
+        # releasing the lock at exit doesnt block
+        mirror = repo_cache.mirror(repo_url)
+        mirror_path = await loop.run_in_executor(None, mirror.__enter__)
+        try:
+            # local clone, objects are hardlinked, so there is no need for a blob filter
+            command = ["git", "clone", mirror_path, tmp_dir_path]
+            if blobless:
+                command.insert(2, "--no-checkout")
+            await git_execute_async(command)
+        finally:
+            mirror.__exit__(*sys.exc_info())
+    else:
+        if blobless:
+            # history (commits and trees) without blobs, servers which dont support filters send a full clone
+            command = ["git", "clone", "--filter=blob:none", "--no-checkout", repo_url, tmp_dir_path]
+        else:
+            command = ["git", "clone", repo_url, tmp_dir_path]
+        await git_execute_async(command, env={"GIT_TERMINAL_PROMPT": "0"})
+
+
+async def get_repo_data_from_git_async(ref, repo_url, blobless=False, repo_cache=None, executor=None):
+    """
+    same as utils.get_repo_data_from_git, but git commands are awaited and
+    buildpack detection runs in the given executor.
+    """
+    loop = asyncio.get_event_loop()
+    repo_data = {
+        "resolved_date": datetime.utcnow().replace(second=0, microsecond=0).isoformat(),
+        "resolved_ref": None,
+        "resolved_ref_date": None,
+        "binder_dir": None,
+        "buildpack": None,
+    }
+    # clones from mirrors are on the same file system as the cache
+    tmp_root = repo_cache.tmp_dir if repo_cache is not None else None
+    tmp_dir_path = tempfile.mkdtemp(dir=tmp_root)
+    try:
+        await _clone(repo_url, tmp_dir_path, blobless, repo_cache)
+
+        if blobless:
+            resolved_ref = await resolve_ref_async(ref, tmp_dir_path)
+            if resolved_ref is None:
+                # same as below, when ref doesnt exist in the repo
+                repo_data["resolved_ref"] = "404"
+                return repo_data
+        else:
+            # check if resolved ref exists in repo
+            # it is possible that a commit, which is launched, is removed from history
+            command = ["git", "checkout", ref]
+            try:
+                await git_execute_async(command, tmp_dir_path)
+            except Exception as e:
+                if _is_unknown_ref_error(e, ref):
+                    repo_data["resolved_ref"] = "404"
+                    return repo_data
+                else:
+                    raise e
+            command = ["git", "rev-parse", "HEAD"]
+            result = await git_execute_async(command, tmp_dir_path)
+            resolved_ref = result.stdout.strip()
+        repo_data["resolved_ref"] = resolved_ref
+
+        # get commit date of resolved ref
+        command = ["git", "show", "-s", "--format=%cI", resolved_ref]
+        result = await git_execute_async(command, tmp_dir_path)
+        repo_data["resolved_ref_date"] = _to_utc_isoformat(result.stdout.strip())
+
+        detected = None
+        if blobless:
+            # detect from tree listing and if it is not possible, check out only the necessary files
+            command = ["git", "ls-tree", "-r", "-t", "-z", "--full-tree", resolved_ref]
+            result = await git_execute_async(command, tmp_dir_path)
+            tree = _parse_git_tree(result.stdout)
+            detected = await loop.run_in_executor(executor, detect_buildpack_from_tree, tree, tmp_dir_path)
+            if detected is None:
+                # see utils.checkout_detect_files
+                detect_paths = _get_detect_paths(tree)
+                if detect_paths is None:
+                    command = ["git", "checkout", resolved_ref]
+                else:
+                    paths, dirs = detect_paths
+                    for dir_ in dirs:
+                        os.makedirs(os.path.join(tmp_dir_path, dir_), exist_ok=True)
+                    command = ["git", "checkout", resolved_ref, "--", *paths] if paths else None
+                if command:
+                    await git_execute_async(command, tmp_dir_path)
+        if detected is None:
+            detected = await loop.run_in_executor(executor, detect_buildpack, tmp_dir_path)
+        repo_data["binder_dir"], repo_data["buildpack"] = detected
+    finally:
+        # removing a large clone takes a while
+        await loop.run_in_executor(None, shutil.rmtree, tmp_dir_path, True)
+    return repo_data
+
+
+class GitEngine:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, host_concurrency=DEFAULT_HOST_CONCURRENCY,
+                 detect_workers=2, retries=3, logger=None):
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.retries = retries
+        self.logger = logger
+        # worker processes are started from the thread of the loop, "spawn" is safe with threads
+        self.detect_executor = ProcessPoolExecutor(max_workers=detect_workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        self.loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8):
+            # before python 3.8 subprocesses can only be watched by a loop which is attached in the main thread
+            asyncio.get_child_watcher().attach_loop(self.loop)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self._started = threading.Event()
+        self.running = False
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        # asyncio objects are created in the loop of this thread
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.host_slots = defaultdict(lambda: asyncio.Semaphore(self.host_concurrency))
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    async def _get_repo_data(self, ref, repo_url, blobless, repo_cache):
+        host = urlparse(repo_url).hostname
+        retry = self.retries
+        while True:
+            # slot of the host first, so repos of a busy host dont hold slots of other hosts
+            async with self.host_slots[host], self.slots:
+                try:
+                    return await get_repo_data_from_git_async(ref, repo_url, blobless, repo_cache,
+                                                              self.detect_executor)
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.info(f'Error while processing {repo_url}, attempt {self.retries - retry + 1}')
+                        self.logger.exception(f'{repo_url}')
+                    error = e
+            # same backoff as create_repo_table.get_repo_data (27, 4, 1 seconds), without holding a slot
+            await asyncio.sleep(retry ** retry)
+            retry -= 1
+            if not retry:
+                raise error
+
+    def start(self):
+        self.thread.start()
+        self._started.wait()
+        self.running = True
+
+    def submit(self, ref, repo_url, blobless=False, repo_cache=None):
+        """adds a repo to process, returns a concurrent.futures.Future of its repo data"""
+        return asyncio.run_coroutine_threadsafe(self._get_repo_data(ref, repo_url, blobless, repo_cache), self.loop)
+
+    def stop(self):
+        if self.running:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.running = False
+        self.detect_executor.shutdown()
@@ -0,0 +1,194 @@
+"""
+Local stub of GitHub API to test and benchmark create_repo_table.py without hitting GitHub.
+
+It answers GraphQL batch queries of `utils.get_repos_data_from_github_graphql` and
+REST requests of `utils.get_repo_data_from_github_api` (GET /repos/<owner>/<name> and GET /gists/<id>).
+REST responses have an ETag, conditional requests of not modified repos get 304 and don't count against rate limit.
+GET /rate_limit (which PyGithub requests when it doesnt know the rate limit yet) doesn't count either.
+
+Repos are given as a json file, repos which are not in this file don't exist (404),
+repos with a status are answered with that status, e.g. blocked repos (451 or 403 without exceeding rate limit):
+
+    {
+        "<owner>/<name>": {"id": 1, "fork": false, "default_branch": "master"},
+        "<owner>/<blocked>": {"status": 451},
+        "<owner>/<forbidden>": {"status": 403},
+        "gist:<gist id>": {"fork": false}
+    }
+"""
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ALIAS_PATTERN = re.compile(r"(r\d+): repository\(owner: \$(o\d+), name: \$(n\d+)\)")
+# requests are counted over threads of the server
+lock = threading.Lock()
+
+
+class GithubAPIStubHandler(BaseHTTPRequestHandler):
+    # set by serve_github_api
+    repos = {}
+    # number of requests of a token until rate limit is exceeded, None for unlimited
+    rate_limit = None
+    # length of rate limit window in seconds
+    reset_seconds = 3600
+    request_count = 0
+    # number of 304 responses
+    not_modified_count = 0
+    # {token: [request count, reset timestamp]} of current rate limit windows
+    windows = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _get_window(self):
+        """returns [request count, reset timestamp] of the token of this request"""
+        token = self.headers.get("Authorization", "")
+        now = time.time()
+        window = self.windows.get(token)
+        if window is None or window[1] <= now:
+            window = self.windows[token] = [0, int(now) + self.reset_seconds]
+        return window
+
+    def _get_rate(self):
+        """returns (limit, remaining, reset timestamp, used) of the token of this request"""
+        with lock:
+            count, reset_ts = self._get_window()
+        remaining = max(0, self.rate_limit - count) if self.rate_limit is not None else 5000
+        return self.rate_limit or 5000, remaining, reset_ts, count
+
+    def _send(self, status, data, etag=None):
+        body = json.dumps(data).encode() if status != 304 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        limit, remaining, reset_ts, _ = self._get_rate()
+        self.send_header("X-RateLimit-Limit", str(limit))
+        self.send_header("X-RateLimit-Remaining", str(remaining))
+        self.send_header("X-RateLimit-Reset", str(reset_ts))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count_request(self, not_modified=False):
+        """returns False if rate limit of the token is exceeded"""
+        with lock:
+            GithubAPIStubHandler.request_count += 1
+            if not_modified:
+                GithubAPIStubHandler.not_modified_count += 1
+                return True
+            window = self._get_window()
+            window[0] += 1
+            return self.rate_limit is None or window[0] <= self.rate_limit
+
+    def _get_repo(self, key):
+        repo = self.repos.get(key)
+        if repo is None:
+            return 404, {"message": "Not Found"}
+        if "status" in repo:
+            return repo["status"], {"message": "Repository access blocked"}
+        return 200, repo
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/").split("/")
+        if path == ["rate_limit"]:
+            rate = dict(zip(["limit", "remaining", "reset", "used"], self._get_rate()))
+            return self._send(200, {"resources": {"core": rate, "search": rate, "graphql": rate}, "rate": rate})
+        if len(path) == 3 and path[0] == "repos":
+            full_name = f"{path[1]}/{path[2]}"
+            status, data = self._get_repo(full_name)
+            if status == 200:
+                data = {"id": data["id"], "fork": data.get("fork", False), "full_name": full_name,
+                        "name": path[2], "default_branch": data.get("default_branch", "master")}
+        elif len(path) == 2 and path[0] == "gists":
+            status, data = self._get_repo(f"gist:{path[1]}")
+            if status == 200:
+                data = {"id": path[1], "fork_of": {"id": "0"} if data.get("fork") else None}
+        else:
+            status, data = 404, {"message": "Not Found"}
+        etag = None
+        if status == 200:
+            etag = f'"{hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self._count_request(not_modified=True)
+                return self._send(304, None, etag)
+        if not self._count_request():
+            return self._send(403, {"message": "API rate limit exceeded"})
+        return self._send(status, data, etag)
+
+    def do_POST(self):
+        content = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.strip("/") != "graphql":
+            return self._send(404, {"message": "Not Found"})
+        if not self._count_request():
+            return self._send(200, {"errors": [{"type": "RATE_LIMITED", "message": "API rate limit exceeded"}]})
+        variables = content.get("variables", {})
+        data = {}
+        errors = []
+        for alias, owner_var, name_var in ALIAS_PATTERN.findall(content["query"]):
+            full_name = f"{variables[owner_var]}/{variables[name_var]}"
+            status, repo = self._get_repo(full_name)
+            if status == 200:
+                branch = repo.get("default_branch", "master")
+                data[alias] = {"databaseId": repo["id"], "isFork": repo.get("fork", False),
+                               "defaultBranchRef": {"name": branch} if branch else None}
+            else:
+                data[alias] = None
+                errors.append({"type": "NOT_FOUND" if status == 404 else "FORBIDDEN", "path": [alias],
+                               "message": f"Could not resolve to a Repository with the name '{full_name}'."})
+        result = {"data": data}
+        if errors:
+            result["errors"] = errors
+        return self._send(200, result)
+
+
+def serve_github_api(repos, port=0, rate_limit=None, reset_seconds=3600):
+    """serves stub API in a background thread, returns the server.
+    api url is f"http://127.0.0.1:{server.server_port}" """
+    GithubAPIStubHandler.repos = repos
+    GithubAPIStubHandler.rate_limit = rate_limit
+    GithubAPIStubHandler.reset_seconds = reset_seconds
+    GithubAPIStubHandler.request_count = 0
+    GithubAPIStubHandler.not_modified_count = 0
+    GithubAPIStubHandler.windows = {}
+    server = ThreadingHTTPServer(("127.0.0.1", port), GithubAPIStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='This script runs a local stub of GitHub API with given repos.'
+                                                 '\nExample command: '
+                                                 '\n\tpython github_api_stub.py -r repos.json -p 8000'
+                                                 '\n\tpython create_repo_table.py -n example.db -t token -g '
+                                                 '--github_api_url http://127.0.0.1:8000',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-r', '--repos', required=True, help='Json file of repos.')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Default is 8000.')
+    parser.add_argument('-l', '--rate_limit', type=int, default=None,
+                        help='Number of requests per token until rate limit is exceeded. Default is unlimited.')
+    parser.add_argument('-w', '--reset_seconds', type=int, default=3600,
+                        help='Length of rate limit window in seconds. Default is 3600.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    with open(args.repos) as f:
+        repos = json.load(f)
+    server = serve_github_api(repos, args.port, args.rate_limit, args.reset_seconds)
+    print(f"GitHub API stub is running at http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
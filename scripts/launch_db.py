@@ -0,0 +1,506 @@
+"""
+Storage of launch events (`mybinderlaunch` table) in the sqlite3 database
+
+In compact mode launches are saved into `mybinderlaunch_compact` table, where repeated text values are
+replaced by ids of small lookup tables (`launch_<column>`) and timestamp is saved as minutes since epoch.
+Then `mybinderlaunch` is a view with the same columns as the normal launch table.
+"""
+import pandas as pd
+from time import time
+from datetime import datetime, timedelta, timezone
+from utils import LAUNCH_TABLE as launch_table, INGEST_MANIFEST_TABLE as manifest_table
+
+# columns of launch table, in the order that they are saved
+LAUNCH_COLUMNS = {
+    "timestamp": str,
+    "version": int,
+    "origin": str,
+    "provider": str,
+    "spec": str,
+    "org": str,
+    "ref": str,
+    "resolved_ref": str,
+    "r2d_version": str,
+    "repo_url": str,
+}
+
+# columns which are saved as ids of lookup tables in compact mode
+DICTIONARY_COLUMNS = ["version", "origin", "provider", "org", "r2d_version", "repo_url"]
+compact_table = f"{launch_table}_compact"
+
+# indexes which are built after bulk load, they match the queries on launch table
+# in create_repo_table.py and in analysis notebooks
+LAUNCH_INDEXES = [
+    # aggregation of launches per repo: count, first/last launch and spec of the last launch
+    ["repo_url", "timestamp", "spec"],
+    # filtering by provider and distinct repos per provider
+    ["provider", "repo_url"],
+    # time ranges, e.g. launches of a day or first and last launch
+    ["timestamp"],
+    # launches per origin
+    ["origin"],
+]
+
+# one row per archive day
+MANIFEST_COLUMNS = {
+    "archive_date": str,
+    "a_name": str,
+    "row_count": int,
+    # sha256 of the archive file
+    "checksum": str,
+    # "done" or "failed"
+    "status": str,
+    "attempts": int,
+    "error": str,
+    "ingested_at": str,
+}
+
+# number of launches which are updated in one transaction when repo_id is set
+REPO_ID_BATCH_SIZE = 500000
+
+# rowid ranges of saved batches of archive days which are not finished yet
+range_table = "ingest_batch"
+
+# daily rollups of launches, they are updated when an archive day is saved
+# launches per repo and day
+daily_repo_table = "launch_daily_repo"
+DAILY_REPO_COLUMNS = {
+    "date": str,
+    "provider": str,
+    "repo_url": str,
+    "launch_count": int,
+    "first_launch_ts": str,
+    "last_launch_ts": str,
+    # spec of the last launch of the day
+    "last_spec": str,
+}
+# launches per provider, origin and day
+daily_origin_table = "launch_daily_origin"
+DAILY_ORIGIN_COLUMNS = {
+    "date": str,
+    "provider": str,
+    "origin": str,
+    "launch_count": int,
+}
+
+# number of rows to insert in one transaction
+WRITE_BATCH_SIZE = 200000
+
+
+def is_compact(db):
+    return compact_table in db.table_names()
+
+
+def launch_table_exists(db):
+    return launch_table in db.table_names() or is_compact(db)
+
+
+def get_lookup_table(column):
+    return f"launch_{column}"
+
+
+def create_launch_table(db, compact=False):
+    if launch_table_exists(db):
+        return
+    if not compact:
+        db[launch_table].create(LAUNCH_COLUMNS)
+        return
+    columns = {}
+    for column, type_ in LAUNCH_COLUMNS.items():
+        if column == "timestamp":
+            # minutes since epoch, events are in minute resolution
+            columns[column] = int
+        elif column in DICTIONARY_COLUMNS:
+            db[get_lookup_table(column)].create({"id": int, "value": type_}, pk="id")
+            db[get_lookup_table(column)].create_index(["value"], unique=True)
+            columns[f"{column}_id"] = int
+        else:
+            columns[column] = type_
+    db[compact_table].create(columns)
+    create_launch_view(db)
+
+
+def _get_compact_select(db, repo_id=True):
+    # select of compact launch table with the columns of the normal launch table
+    # and repo_id, if repo_id is True and it is already set
+    select = []
+    joins = []
+    for column in LAUNCH_COLUMNS:
+        if column == "timestamp":
+            select.append(f"strftime('%Y-%m-%dT%H:%M:%S', l.timestamp * 60, 'unixepoch') AS timestamp")
+        elif column in DICTIONARY_COLUMNS:
+            lookup_table = get_lookup_table(column)
+            select.append(f"{lookup_table}.value AS {column}")
+            joins.append(f"LEFT JOIN {lookup_table} ON {lookup_table}.id = l.{column}_id")
+        else:
+            select.append(f"l.{column} AS {column}")
+    repo_url_table = get_lookup_table("repo_url")
+    if repo_id and "repo_id" in db[repo_url_table].columns_dict:
+        # see set_launch_repo_ids
+        select.append(f"{repo_url_table}.repo_id AS repo_id")
+    return f"SELECT {', '.join(select)} FROM {compact_table} AS l {' '.join(joins)}"
+
+
+def create_launch_view(db):
+    """(re-)creates the view which shows the compact launch table with the columns of the normal launch table"""
+    with db.conn:
+        db.conn.execute(f"DROP VIEW IF EXISTS {launch_table};")
+        db.conn.execute(f"CREATE VIEW {launch_table} AS {_get_compact_select(db)};")
+
+
+def to_epoch_minutes(timestamp):
+    """converts "YYYY-MM-DDTHH:MM:SS" timestamp in UTC into minutes since epoch"""
+    date_ = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    return int(date_.timestamp()) // 60
+
+
+def get_launches_of_day_query(db, archive_date):
+    """returns query and its parameters to select launches of a day with LAUNCH_COLUMNS,
+    so the columns dont depend on whether repo_id is set (create_repo_table.py).
+    query uses the timestamp index of the launch table in both modes"""
+    date_ = datetime.strptime(str(archive_date), "%Y-%m-%d")
+    start, end = date_.isoformat(), (date_ + timedelta(days=1)).isoformat()
+    if is_compact(db):
+        query = f"{_get_compact_select(db, repo_id=False)} WHERE l.timestamp >= ? AND l.timestamp < ?;"
+        return query, (to_epoch_minutes(start), to_epoch_minutes(end))
+    query = f"SELECT {', '.join(LAUNCH_COLUMNS)} FROM {launch_table} WHERE timestamp >= ? AND timestamp < ?;"
+    return query, (start, end)
+
+
+def build_launch_indexes(db):
+    """builds indexes in LAUNCH_INDEXES (if they dont exist) and updates statistics for the query planner.
+    returns list of (index name, build duration in seconds) of new indexes"""
+    table = compact_table if is_compact(db) else launch_table
+    existing = {row[0] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type='index';")}
+    timings = []
+    for columns in LAUNCH_INDEXES:
+        if is_compact(db):
+            columns = [f"{c}_id" if c in DICTIONARY_COLUMNS else c for c in columns]
+        index_name = f"idx_{table}_{'_'.join(columns)}"
+        if index_name in existing:
+            continue
+        start_time = time()
+        with db.conn:
+            db.conn.execute(f"CREATE INDEX {index_name} ON {table} ({', '.join(columns)});")
+        timings.append((index_name, time() - start_time))
+    if timings:
+        # https://www.sqlite.org/lang_analyze.html
+        db.conn.execute("ANALYZE;")
+        db.conn.commit()
+    return timings
+
+
+def set_launch_repo_ids(db, repo_table, only_missing=False, batch_size=REPO_ID_BATCH_SIZE, progress=None):
+    """adds repo_id column into launch table (if not exists) and sets it from repo table.
+    in compact mode repo_id is saved in the lookup table of repo_url, so only distinct repo urls are updated.
+    otherwise launches are updated in rowid ranges of batch_size, each in its own transaction,
+    and progress(last rowid, max rowid) is called after each range.
+    rows which already have the right repo_id are not written again, so an interrupted update continues quickly.
+    if only_missing is True, only rows without repo_id are updated, e.g. new launches after an incremental refresh,
+    ids of existing repos don't change."""
+    db.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{repo_table}_repo_url ON {repo_table} (repo_url);")
+    # repo ids by repo_url, each launch is updated with a primary key search in this small table
+    # instead of a search in repo table
+    url_table = f"{repo_table}_url_id"
+    with db.conn:
+        db.conn.execute(f"DROP TABLE IF EXISTS temp.{url_table};")
+        db.conn.execute(f"CREATE TEMP TABLE {url_table} (repo_url TEXT PRIMARY KEY, repo_id INTEGER) WITHOUT ROWID;")
+        db.conn.execute(f"""INSERT OR IGNORE INTO {url_table} 
+                            SELECT repo_url, id FROM {repo_table} WHERE repo_url IS NOT NULL ORDER BY id;""")
+    if is_compact(db):
+        table, url_column = get_lookup_table("repo_url"), "value"
+        if "repo_id" not in db[table].columns_dict:
+            db[table].add_column("repo_id", fk=repo_table, fk_col="id")
+            create_launch_view(db)
+    else:
+        table, url_column = launch_table, "repo_url"
+        if "repo_id" not in db[table].columns_dict:
+            db[table].add_column("repo_id", fk=repo_table, fk_col="id")
+    repo_id = f"(SELECT repo_id FROM {url_table} WHERE repo_url={table}.{url_column})"
+    if only_missing:
+        where = f"repo_id IS NULL AND {repo_id} IS NOT NULL"
+    else:
+        where = f"repo_id IS NOT {repo_id}"
+    sql = f"UPDATE {table} SET repo_id={repo_id} WHERE {where}"
+    if is_compact(db):
+        with db.conn:
+            db.conn.execute(f"{sql};")
+    else:
+        max_rowid = db.conn.execute(f"SELECT max(rowid) FROM {table};").fetchone()[0] or 0
+        for start in range(0, max_rowid, batch_size):
+            end = min(start + batch_size, max_rowid)
+            with db.conn:
+                db.conn.execute(f"{sql} AND rowid > ? AND rowid <= ?;", (start, end))
+            if progress is not None:
+                progress(end, max_rowid)
+    db.conn.execute(f"DROP TABLE temp.{url_table};")
+    db.conn.commit()
+
+
+def create_manifest_table(db):
+    if manifest_table not in db.table_names():
+        db[manifest_table].create(MANIFEST_COLUMNS, pk="archive_date")
+
+
+def get_ingested_until(db):
+    """returns ingested_at of the last saved archive day or None"""
+    if manifest_table not in db.table_names():
+        return None
+    return db.conn.execute(f"SELECT max(ingested_at) FROM {manifest_table};").fetchone()[0]
+
+
+def get_manifest(db):
+    """returns ingest manifest as dict {archive_date: row}"""
+    if manifest_table not in db.table_names():
+        return {}
+    return {row["archive_date"]: row for row in db[manifest_table].rows}
+
+
+def get_launch_rollups(df):
+    """aggregates launches in df per (provider, repo_url) and per (provider, origin).
+    returns 2 lists: ((provider, repo_url), launch_count, first_launch_ts, last_launch_ts, last_spec)
+    and ((provider, origin), launch_count), they are merged and saved by LaunchWriter"""
+    # groupby drops null keys, so they are replaced by "" here and by None again when saved
+    df = df[["timestamp", "spec"]].join(df[["provider", "repo_url", "origin"]].fillna(""))
+    # last spec is the max spec of launches at the last timestamp, as in create_repo_table,
+    # so it doesnt depend on the order of launches in the archive
+    df = df.sort_values(["timestamp", "spec"], na_position="first")
+    keys = ["provider", "repo_url"]
+    repos = df.groupby(keys, sort=False).agg(
+        launch_count=("timestamp", "size"),
+        first_launch_ts=("timestamp", "first"),
+        last_launch_ts=("timestamp", "last"),
+    )
+    # "last" of groupby skips nulls
+    repos["last_spec"] = df.drop_duplicates(keys, keep="last").set_index(keys)["spec"]
+    origins = df.groupby(["provider", "origin"], sort=False).size()
+    return list(repos.itertuples(name=None)), list(origins.items())
+
+
+def rollups_exist(db):
+    return daily_repo_table in db.table_names() and daily_origin_table in db.table_names()
+
+
+def df_to_rows(df):
+    """returns launches in df as a list of tuples in order of LAUNCH_COLUMNS, NaN values are converted to None"""
+    df = df[list(LAUNCH_COLUMNS)]
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+class LaunchWriter:
+    """
+    Single writer of the launch table and of the ingest manifest.
+    Batches of rows parsed by worker processes are collected here and inserted in large transactions
+    with a prepared statement, so workers never compete for the write lock of the database.
+    Rowid ranges of inserted batches are recorded until their day is finished,
+    so launches of a failed (or interrupted) day can be removed again.
+    Rollups of batches are merged in memory and saved into daily rollup tables when their day is finished.
+    An archive day is marked as "done" in the manifest only after all of its launches are saved.
+    If the launch table doesnt exist yet, it is created in compact mode if compact is True,
+    otherwise mode of the existing table is used.
+    """
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, compact=False):
+        self.db = db
+        self.batch_size = batch_size
+        # (archive_date, rows) of buffered batches
+        self.batches = []
+        self.row_count = 0
+        # (manifest entry, replace) of finished days
+        self.days = []
+        # {archive_date: ({(provider, repo_url): [count, first ts, last ts, last spec]}, {(provider, origin): count})}
+        self.rollups = {}
+        create_launch_table(db, compact)
+        create_manifest_table(db)
+        self.compact = is_compact(db)
+        if self.compact:
+            self.table = compact_table
+            columns = [f"{c}_id" if c in DICTIONARY_COLUMNS else c for c in LAUNCH_COLUMNS]
+            # {column: {value: id}} of lookup tables
+            self.lookups = {}
+            for column in DICTIONARY_COLUMNS:
+                lookup = {}
+                for id_, value in db.conn.execute(f"SELECT id, value FROM {get_lookup_table(column)};"):
+                    lookup[value] = id_
+                self.lookups[column] = lookup
+            # cache of timestamp -> minutes since epoch
+            self.minutes = {}
+        else:
+            self.table = launch_table
+            columns = list(LAUNCH_COLUMNS)
+        self.insert_sql = f"INSERT INTO {self.table} ({', '.join(columns)}) " \
+                          f"VALUES ({', '.join(['?'] * len(columns))});"
+        self.manifest_sql = f"INSERT OR REPLACE INTO {manifest_table} ({', '.join(MANIFEST_COLUMNS)}) " \
+                            f"VALUES ({', '.join(['?'] * len(MANIFEST_COLUMNS))});"
+        if range_table not in db.table_names():
+            db[range_table].create({"archive_date": str, "first_rowid": int, "last_rowid": int})
+        # remove launches of days which were not finished in a previous run
+        with db.conn:
+            for (archive_date, ) in db.conn.execute(f"SELECT DISTINCT archive_date FROM {range_table};").fetchall():
+                self._delete_unfinished(archive_date)
+        self.daily_repo_sql = f"INSERT INTO {daily_repo_table} ({', '.join(DAILY_REPO_COLUMNS)}) " \
+                              f"VALUES ({', '.join(['?'] * len(DAILY_REPO_COLUMNS))});"
+        self.daily_origin_sql = f"INSERT INTO {daily_origin_table} ({', '.join(DAILY_ORIGIN_COLUMNS)}) " \
+                                f"VALUES ({', '.join(['?'] * len(DAILY_ORIGIN_COLUMNS))});"
+        if not rollups_exist(db):
+            self._create_rollups()
+
+    def _create_rollups(self):
+        """creates daily rollup tables and fills them with launches of days which are already saved"""
+        for table, columns in [(daily_repo_table, DAILY_REPO_COLUMNS), (daily_origin_table, DAILY_ORIGIN_COLUMNS)]:
+            if table in self.db.table_names():
+                self.db[table].drop()
+            self.db[table].create(columns)
+            self.db[table].create_index(["date"])
+        # to select spec of the last launch of each repo, see create_repo_table.create_repo_candidates
+        self.db[daily_repo_table].create_index(["repo_url", "last_launch_ts", "last_spec"])
+        for archive_date, entry in sorted(get_manifest(self.db).items()):
+            if entry["status"] != "done":
+                continue
+            query, params = get_launches_of_day_query(self.db, archive_date)
+            df = pd.read_sql_query(query, self.db.conn, params=params)
+            if len(df):
+                self._merge_rollups(archive_date, get_launch_rollups(df))
+            with self.db.conn:
+                self._save_rollups(archive_date)
+
+    def _manifest_entry(self, archive_date, row_count, checksum, status, attempts, error=None):
+        return (str(archive_date), f"events-{archive_date}.jsonl", row_count, checksum, status, attempts, error,
+                datetime.utcnow().replace(microsecond=0).isoformat())
+
+    def _to_minutes(self, timestamp):
+        minutes = self.minutes.get(timestamp)
+        if minutes is None:
+            minutes = to_epoch_minutes(timestamp)
+            self.minutes[timestamp] = minutes
+        return minutes
+
+    def _day_range(self, archive_date):
+        """returns start of the day and start of the next day as saved in timestamp column"""
+        date_ = datetime.strptime(archive_date, "%Y-%m-%d")
+        start, end = date_.isoformat(), (date_ + timedelta(days=1)).isoformat()
+        if self.compact:
+            return self._to_minutes(start), self._to_minutes(end)
+        return start, end
+
+    def _encode(self, rows):
+        """replaces values with ids of lookup tables in compact mode, new values are inserted into lookup tables.
+        must be called in a transaction"""
+        if not self.compact:
+            return rows
+        indices = [i for i, column in enumerate(LAUNCH_COLUMNS) if column in DICTIONARY_COLUMNS]
+        lookups = [self.lookups[column] for column in LAUNCH_COLUMNS if column in DICTIONARY_COLUMNS]
+        lookup_tables = [get_lookup_table(column) for column in LAUNCH_COLUMNS if column in DICTIONARY_COLUMNS]
+        encoded_rows = []
+        for row in rows:
+            row = list(row)
+            row[0] = self._to_minutes(row[0])
+            for i, lookup, lookup_table in zip(indices, lookups, lookup_tables):
+                value = row[i]
+                if value is None:
+                    continue
+                id_ = lookup.get(value)
+                if id_ is None:
+                    id_ = self.db.conn.execute(f"INSERT INTO {lookup_table} (value) VALUES (?);", (value, )).lastrowid
+                    lookup[value] = id_
+                row[i] = id_
+            encoded_rows.append(row)
+        return encoded_rows
+
+    def _delete_unfinished(self, archive_date):
+        # must be called in a transaction
+        for first_rowid, last_rowid in self.db.conn.execute(
+                f"SELECT first_rowid, last_rowid FROM {range_table} WHERE archive_date=?;", (archive_date, )):
+            self.db.conn.execute(f"DELETE FROM {self.table} WHERE rowid BETWEEN ? AND ?;", (first_rowid, last_rowid))
+        self.db.conn.execute(f"DELETE FROM {range_table} WHERE archive_date=?;", (archive_date, ))
+
+    def _merge_rollups(self, archive_date, rollups):
+        repos, origins = self.rollups.setdefault(archive_date, ({}, {}))
+        repo_rows, origin_rows = rollups
+        for key, launch_count, first_launch_ts, last_launch_ts, last_spec in repo_rows:
+            repo = repos.get(key)
+            if repo is None:
+                repos[key] = [int(launch_count), first_launch_ts, last_launch_ts, last_spec]
+                continue
+            repo[0] += int(launch_count)
+            if first_launch_ts < repo[1]:
+                repo[1] = first_launch_ts
+            # max spec at the last timestamp (nulls are ignored as in MAX of sqlite)
+            if last_launch_ts > repo[2] or \
+                    (last_launch_ts == repo[2] and isinstance(last_spec, str) and
+                     (not isinstance(repo[3], str) or last_spec > repo[3])):
+                repo[2], repo[3] = last_launch_ts, last_spec
+        for key, launch_count in origin_rows:
+            origins[key] = origins.get(key, 0) + int(launch_count)
+
+    def _save_rollups(self, archive_date):
+        # must be called in a transaction
+        for table in [daily_repo_table, daily_origin_table]:
+            self.db.conn.execute(f"DELETE FROM {table} WHERE date=?;", (archive_date, ))
+        repos, origins = self.rollups.pop(archive_date, ({}, {}))
+        self.db.conn.executemany(self.daily_repo_sql,
+                                 [(archive_date, provider or None, repo_url or None, *repo)
+                                  for (provider, repo_url), repo in repos.items()])
+        self.db.conn.executemany(self.daily_origin_sql,
+                                 [(archive_date, provider or None, origin or None, launch_count)
+                                  for (provider, origin), launch_count in origins.items()])
+
+    def add(self, archive_date, rows, rollups=None):
+        """adds a batch of launches of an archive day and their rollups (output of get_launch_rollups)"""
+        archive_date = str(archive_date)
+        if rollups is not None:
+            self._merge_rollups(archive_date, rollups)
+        self.batches.append((archive_date, rows))
+        self.row_count += len(rows)
+        if self.row_count >= self.batch_size:
+            self.flush()
+
+    def finish_day(self, archive_date, row_count, checksum, attempts=1, replace=False):
+        """marks an archive day as done, after all of its batches are added.
+        if replace is True, launches of that day, which were saved in a previous run, are deleted."""
+        self.days.append((self._manifest_entry(archive_date, row_count, checksum, "done", attempts), replace))
+
+    def fail_day(self, archive_date, error=None, attempts=1):
+        """removes launches of a failed archive day, if error is given, it is marked as failed in the manifest"""
+        archive_date = str(archive_date)
+        self.batches = [(date_, rows) for date_, rows in self.batches if date_ != archive_date]
+        self.rollups.pop(archive_date, None)
+        self.row_count = sum(len(rows) for _, rows in self.batches)
+        with self.db.conn:
+            self._delete_unfinished(archive_date)
+            if error is not None:
+                self.db.conn.execute(self.manifest_sql,
+                                     self._manifest_entry(archive_date, None, None, "failed", attempts, error))
+
+    def flush(self):
+        if not self.batches and not self.days:
+            return
+        # one transaction for all buffered rows
+        with self.db.conn:
+            for archive_date, rows in self.batches:
+                if not rows:
+                    continue
+                first_rowid = (self.db.conn.execute(f"SELECT max(rowid) FROM {self.table};").fetchone()[0] or 0) + 1
+                self.db.conn.executemany(self.insert_sql, self._encode(rows))
+                self.db.conn.execute(f"INSERT INTO {range_table} VALUES (?, ?, ?);",
+                                     (archive_date, first_rowid, first_rowid + len(rows) - 1))
+            for entry, replace in self.days:
+                archive_date = entry[0]
+                if replace:
+                    # events of an archive day are launched on that day,
+                    # new launches of the day have higher rowids than the old ones
+                    first_rowid = self.db.conn.execute(
+                        f"SELECT min(first_rowid) FROM {range_table} WHERE archive_date=?;", (archive_date, )
+                    ).fetchone()[0]
+                    if first_rowid is None:
+                        first_rowid = (self.db.conn.execute(f"SELECT max(rowid) FROM {self.table};").fetchone()[0]
+                                       or 0) + 1
+                    self.db.conn.execute(f"DELETE FROM {self.table} "
+                                         f"WHERE timestamp >= ? AND timestamp < ? AND rowid < ?;",
+                                         (*self._day_range(archive_date), first_rowid))
+                self.db.conn.execute(f"DELETE FROM {range_table} WHERE archive_date=?;", (archive_date, ))
+                self._save_rollups(archive_date)
+            self.db.conn.executemany(self.manifest_sql, [entry for entry, _ in self.days])
+        self.batches = []
+        self.row_count = 0
+        self.days = []
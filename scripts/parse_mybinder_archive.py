@@ -2,16 +2,47 @@
 Parser for mybinder.org events archive (https://archive.analytics.mybinder.org/)
 """
 import argparse
+import numpy as np
 import pandas as pd
 import os
+from bisect import bisect_left
+from functools import lru_cache
+from urllib.parse import unquote
 from datetime import datetime, timedelta
 from sqlite_utils import Database
 from concurrent.futures.process import ProcessPoolExecutor
-from concurrent.futures import as_completed
+from time import time
+from multiprocessing import Manager
+import queue
+try:
+    # faster json decoder, if available
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+from archive_cache import ArchiveCache, ArchiveDownloader, ARCHIVE_URL, DEFAULT_CACHE_DIR
+from launch_db import LaunchWriter, df_to_rows, get_manifest, launch_table_exists, build_launch_indexes, \
+    get_launch_rollups, WRITE_BATCH_SIZE
 from utils import get_ref, get_org, get_repo_url, get_logger, get_mybinder_repo2docker_history, get_utc_ts, \
-                  LAUNCH_TABLE as launch_table
+                  get_r2d_history_index, LAUNCH_TABLE as launch_table
 
 
+# number of attempts to parse an archive and
+# seconds to wait before the first retry, it is doubled for each next retry
+MAX_RETRIES = 3
+RETRY_BACKOFF = 30
+
+# number of events to parse at once
+READ_BATCH_SIZE = 50000
+
+# number of archives to download at the same time
+DOWNLOAD_WORKERS = 4
+
+# number of (provider, spec) pairs to keep parsed in each worker,
+# most launches on a given day are from a small set of repos
+SPEC_CACHE_SIZE = 100000
+
+
+@lru_cache(maxsize=SPEC_CACHE_SIZE)
 def parse_spec(provider, spec):
     ref = get_ref(provider, spec)
     org = get_org(provider, spec)
@@ -22,21 +53,89 @@ def parse_spec(provider, spec):
     return ref, org, repo_url
 
 
-def get_r2d_version(mybinder_r2d_history, timestamp):
-    r2d_version = None
-    for commit_date in sorted(mybinder_r2d_history):
-        # event timestamp is already in UTC and in minute resolution
-        # have commit date also in minute resolution
-        commit_date_in_min = datetime.fromisoformat(commit_date).replace(second=0, microsecond=0).isoformat()
-        if timestamp <= commit_date_in_min:
-            r2d_version = mybinder_r2d_history[commit_date]["old"]
-            break
-    if r2d_version is None:
-        # latest
-        r2d_version = mybinder_r2d_history[commit_date]["new"]
-    # print(commit_date, commit_date_in_min, timestamp)
-    # print(timestamp, commit_date_in_min, r2d_version)
-    return r2d_version
+def _strip_git_suffix(s):
+    # vectorized binderhub.repoproviders.strip_suffix(text, ".git")
+    return s.where(~s.str.endswith(".git"), s.str[:-4])
+
+
+def _parse_github_specs(specs):
+    # same as get_ref, get_org and get_repo_url for GitHub specs in form of "org/repo/ref"
+    parts = specs.str.split("/", n=2, expand=True).reindex(columns=[0, 1, 2])
+    valid = parts[2].notna()
+    parts = parts[valid]
+    repo_url = _strip_git_suffix("https://github.com/" + parts[0] + "/" + _strip_git_suffix(parts[1]))
+    return pd.DataFrame({"ref": parts[2].str.strip("/"),
+                         "org": parts[0],
+                         "repo_url": repo_url.str.lower()})
+
+
+def _parse_gist_specs(specs):
+    # same as get_ref, get_org and get_repo_url for Gist specs in form of "user/gist_id[/ref]"
+    parts = specs.str.split("/", n=3, expand=True).reindex(columns=[0, 1, 2])
+    valid = parts[1].notna()
+    parts = parts[valid]
+    return pd.DataFrame({"ref": parts[2].fillna("master").str.strip("/"),
+                         "org": parts[0],
+                         "repo_url": ("https://gist.github.com/" + parts[1]).str.lower()})
+
+
+def _parse_gitlab_specs(specs):
+    # same as get_ref, get_org and get_repo_url for GitLab specs in form of "quoted_namespace/ref"
+    parts = specs.str.split("/", n=1, expand=True).reindex(columns=[0, 1])
+    namespace = parts[0].map(unquote, na_action="ignore")
+    valid = parts[1].notna() & namespace.str.contains("/", regex=False) & \
+        (parts[1].map(unquote, na_action="ignore") != "")
+    parts, namespace = parts[valid], namespace[valid]
+    return pd.DataFrame({"ref": specs[valid].str.rsplit("/", n=1).str[-1],
+                         "org": namespace.str.split("/", n=1).str[0],
+                         "repo_url": ("https://gitlab.com/" + namespace).str.lower()})
+
+
+SPEC_PARSERS = {
+    "GitHub": _parse_github_specs,
+    "Gist": _parse_gist_specs,
+    "GitLab": _parse_gitlab_specs,
+}
+
+
+def parse_specs(df):
+    """returns ref, org and repo_url columns for provider and spec columns of df.
+    each (provider, spec) pair is parsed only once. GitHub, Gist and GitLab specs are parsed with
+    vectorized string operations, the rest (and invalid ones) with parse_spec, which uses repo providers."""
+    specs = df[["provider", "spec"]].drop_duplicates().set_index(["provider", "spec"]).index
+    parsed = []
+    for provider, parse in SPEC_PARSERS.items():
+        provider_specs = specs[specs.get_level_values("provider") == provider]
+        if len(provider_specs):
+            fast = parse(pd.Series(provider_specs.get_level_values("spec"), index=provider_specs))
+            parsed.append(fast)
+            specs = specs.difference(fast.index)
+    if len(specs):
+        parsed.append(pd.DataFrame([parse_spec(provider, spec) for provider, spec in specs],
+                                   columns=["ref", "org", "repo_url"], index=specs))
+    parsed = pd.concat(parsed)
+    # map each launch to its parsed spec
+    launch_specs = pd.MultiIndex.from_frame(df[["provider", "spec"]])
+    parsed = parsed.reindex(launch_specs)
+    parsed.index = df.index
+    return parsed
+
+
+def get_r2d_version(r2d_index, timestamp):
+    """returns r2d version of mybinder.org at given timestamp,
+    r2d_index is the output of utils.get_r2d_history_index"""
+    boundaries, versions = r2d_index
+    # index of the first commit date which is not before the timestamp
+    return versions[bisect_left(boundaries, timestamp)]
+
+
+def get_r2d_versions(r2d_index, timestamps):
+    """vectorized version of get_r2d_version,
+    returns r2d versions of all timestamps (series of "YYYY-MM-DDTHH:MM:SS" strings) in one pass"""
+    boundaries, versions = r2d_index
+    # same as bisect_left for each timestamp
+    indices = np.searchsorted(np.array(boundaries), timestamps.to_numpy(dtype=str), side="left")
+    return pd.Series(np.array(versions, dtype=object)[indices], index=timestamps.index)
 
 
 def _handle_exceptions_in_archve(df, a_name):
@@ -45,14 +144,14 @@ def _handle_exceptions_in_archve(df, a_name):
         df["origin"] = "mybinder.org"
     # events-2019-06-12.jsonl has mixed rows: with and without origin value
     if a_name == "events-2019-06-12.jsonl":
-        df['origin'].fillna('mybinder.org', inplace=True)
+        df['origin'] = df['origin'].fillna('mybinder.org')
     # events before 18.06.2020 has no (resolved) ref
     if 'ref' not in df.columns:
         # TODO we could use utils.get_resolved_ref(timestamp, provider, spec) when it is implemented
         df['ref'] = ""
     # events-2020-06-18.jsonl has mixed rows: with and without (resolved) ref value
     if a_name == "events-2020-06-18.jsonl":
-        df['ref'].fillna('', inplace=True)
+        df['ref'] = df['ref'].fillna('')
     # NOTE: this query would give us repos with different providers in archive
     #  select count(distinct provider) as c, group_concat(distinct provider), repo_url from mybinderlaunch group by repo_url having c>1;
     # in some archives Gist launches have wrong provider (GitHub)
@@ -72,14 +171,9 @@ def _handle_exceptions_in_archve(df, a_name):
         df.loc[df['spec'] == "bitnik/2b5b3ad303859663b222fa5a6c2d3726", "spec"] = "bitnik/2b5b3ad303859663b222fa5a6c2d3726/master"
 
 
-def parse_archive(archive_date, db_name):
-    """parse archive of given date and save into the database
-    returns number of saved events"""
-    a_name = f"events-{str(archive_date)}.jsonl"
-    archive_url = f"https://archive.analytics.mybinder.org/{a_name}"
-
-    # first read events from archive
-    df = pd.read_json(archive_url, lines=True)
+def parse_events(df, a_name, r2d_index):
+    """parse a batch of events of an archive
+    returns launches as list of rows and their rollups"""
     # drop columns that we dont need for analysis
     # df = df.drop(["schema", "version", "status"], axis=1)
     df = df.drop(["schema", "status"], axis=1)
@@ -97,87 +191,234 @@ def parse_archive(archive_date, db_name):
     # https://www.sqlite.org/datatype3.html#date_and_time_datatype
     # remove timezone info too, it is always UTC
     # df["timestamp"] = df["timestamp"].dt.tz_localize(None)
-    df["timestamp"] = df["timestamp"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True).dt.strftime("%Y-%m-%dT%H:%M:%S")
     # print(df.dtypes)
 
     # generate new columns that we might need for analysis
-    df[["ref", "org", "repo_url"]] = df.apply(lambda row: parse_spec(row["provider"], row["spec"]),
-                                              axis=1,
-                                              result_type='expand')
+    df[["ref", "org", "repo_url"]] = parse_specs(df)
     # add r2d_version for each launch
-    mybinder_r2d_history = get_mybinder_repo2docker_history()
-    df["r2d_version"] = df.apply(lambda row: get_r2d_version(mybinder_r2d_history, row["timestamp"]), axis=1)
-
-    # re-order columns, so more readable
-    df = df[['timestamp', 'version', 'origin', 'provider', 'spec', 'org', 'ref', 'resolved_ref', 'r2d_version', 'repo_url']]
-
-    # save into database, without index
-    # https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.DataFrame.to_sql.html
-    # first connect to db
-    db = Database(db_name)
-    df.to_sql(launch_table, con=db.conn, if_exists="append", index=False)
-
-    return len(df)
+    df["r2d_version"] = get_r2d_versions(r2d_index, df["timestamp"])
+
+    # re-order columns (as in LAUNCH_COLUMNS), so more readable
+    return df_to_rows(df), get_launch_rollups(df)
+
+
+def read_archive(archive_path, batch_size=READ_BATCH_SIZE):
+    """reads archive file (jsonl) and yields events in batches of batch_size as DataFrames"""
+    events = []
+    with open(archive_path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            events.append(json_loads(line))
+            if len(events) == batch_size:
+                yield pd.DataFrame.from_records(events)
+                events = []
+    if events:
+        yield pd.DataFrame.from_records(events)
+
+
+def parse_archive(archive_date, archive_path, r2d_index, batches, batch_size=READ_BATCH_SIZE):
+    """parse archive of given date in batches, so memory usage doesnt depend on size of the archive.
+    archive file is already downloaded by ArchiveDownloader in main process.
+    each batch of launches is put into batches queue as (archive_date, rows, rollups), to be saved by LaunchWriter.
+    returns number of launches."""
+    a_name = f"events-{str(archive_date)}.jsonl"
+    row_count = 0
+    for df in read_archive(archive_path, batch_size):
+        rows, rollups = parse_events(df, a_name, r2d_index)
+        # workers dont write into the database, rows are sent to the single writer in main process
+        # this blocks when writer is behind, so there are at most a few batches in memory
+        batches.put((str(archive_date), rows, rollups))
+        row_count += len(rows)
+    return row_count
+
+
+def _write_batches(batches, writer, timeout=0):
+    """saves batches in the queue until it is empty, waits for the first batch at most timeout seconds"""
+    block = timeout > 0
+    while True:
+        try:
+            archive_date, rows, rollups = batches.get(block, timeout) if block else batches.get_nowait()
+        except queue.Empty:
+            break
+        writer.add(archive_date, rows, rollups)
+        block = False
 
 
-def parse_mybinder_archive(start_date, end_date, db_name, max_workers=1, verbose=False):
+def get_dates_to_parse(start_date, end_date, manifest, incremental=False):
+    """returns dates of archives to parse.
+    in incremental mode skips days which are already saved, except the ones which might still change (today)"""
+    one_day = timedelta(days=1)
+    dates = []
+    current_date = start_date
+    while current_date <= end_date:
+        entry = manifest.get(str(current_date))
+        if not incremental or entry is None or entry["status"] != "done" or \
+           not ArchiveCache.is_immutable(current_date):
+            dates.append(current_date)
+        current_date += one_day
+    return dates
+
+
+def parse_mybinder_archive(start_date, end_date, db_name, max_workers=1, verbose=False, archive_cache=None,
+                           r2d_history=None, write_batch_size=WRITE_BATCH_SIZE, incremental=False,
+                           max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF,
+                           read_batch_size=READ_BATCH_SIZE, compact=False, download_workers=DOWNLOAD_WORKERS,
+                           prefetch=None):
     start_time = datetime.now()
     msg = f"parsing started at {start_time}"
     if verbose:
         print(msg)
     logger.info(msg)
 
-    one_day = timedelta(days=1)
-    current_date = start_date
     counter = 0
     total_events = 0
 
+    if archive_cache is None:
+        archive_cache = ArchiveCache()
+
     db = Database(db_name)
-    if launch_table in db.table_names():
+    if launch_table_exists(db) and not incremental:
         raise Exception(f"table {launch_table} already exists in {db_name}")
+    writer = LaunchWriter(db, write_batch_size, compact)
+    manifest = get_manifest(db)
+    dates = get_dates_to_parse(start_date, end_date, manifest, incremental)
+    msg = f"{len(dates)} archives will be parsed"
+    if verbose:
+        print(msg)
+    logger.info(msg)
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        jobs = {}
-        while current_date <= end_date or jobs:
-            # continue creating new jobs until reaching to last date
-            # or wait until all jobs finish
-            while current_date <= end_date:
-                if verbose:
-                    print(f"parsing archive of {current_date}")
-                job = executor.submit(parse_archive, current_date, db_name)
-                jobs[job] = str(current_date)
-                current_date += one_day
-                counter += 1
-                # limit number of jobs with max_workers
-                if len(jobs) == max_workers:
-                    break
-
-            for job in as_completed(jobs):
-                current_date_ = jobs[job]
-                try:
-                    df_len = job.result()
-                    total_events += df_len
-                    msg = f"{current_date_}: {df_len} events"
+    # r2d history is fetched only once per run and then shared with workers
+    if r2d_history is None:
+        r2d_history = get_mybinder_repo2docker_history(archive_cache.cache_dir, archive_cache.offline)
+    r2d_index = get_r2d_history_index(r2d_history)
+    msg = f"{len(r2d_history)} r2d version changes in mybinder.org"
+    if verbose:
+        print(msg)
+    logger.info(msg)
+
+    def retry_or_fail(current_date_, attempt, exc):
+        entry = manifest.get(str(current_date_))
+        if attempt < max_retries:
+            writer.fail_day(current_date_)
+            retries.append((time() + retry_backoff * 2 ** (attempt - 1), current_date_, attempt + 1))
+            return
+        if entry is None or entry["status"] != "done":
+            # attempts in previous runs are counted too
+            attempts_ = attempt + ((entry["attempts"] or 0) if entry else 0)
+            writer.fail_day(current_date_, f"{type(exc).__name__}: {exc}", attempts_)
+        else:
+            # if it was saved before, keep the old launches
+            writer.fail_day(current_date_)
+        del attempts[current_date_]
+
+    # archives are downloaded in a background thread and parsed in worker processes,
+    # so workers dont wait for the network. downloader prefetches at most `prefetch` archives
+    downloader = ArchiveDownloader(archive_cache, download_workers, prefetch or max_workers * 2)
+    downloader.start()
+    # current attempt of archives which are being downloaded or parsed
+    attempts = {}
+    for date_ in dates:
+        attempts[date_] = 1
+        downloader.request(date_)
+    # (time to request again, date, attempt) of failed archives
+    retries = []
+    try:
+        with Manager() as manager, ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # bounded, so memory usage stays constant when workers are faster than the writer
+            batches = manager.Queue(maxsize=max_workers * 2)
+            # {job: (date, checksum)}
+            jobs = {}
+            while attempts:
+                # failed archives are downloaded and parsed again after their backoff time
+                now = time()
+                for retry in [r for r in retries if r[0] <= now]:
+                    retries.remove(retry)
+                    _, current_date, attempt = retry
+                    attempts[current_date] = attempt
+                    downloader.request(current_date)
+
+                # fill all free workers with downloaded archives
+                while len(jobs) < max_workers:
+                    fetched = downloader.get(block=False)
+                    if fetched is None:
+                        break
+                    current_date, archive_path, checksum, exc = fetched
+                    attempt = attempts[current_date]
+                    if attempt == 1:
+                        counter += 1
+                    if exc is not None:
+                        logger.error(f"Archive {current_date}, attempt {attempt}: {type(exc).__name__}: {exc}")
+                        retry_or_fail(current_date, attempt, exc)
+                        continue
+                    entry = manifest.get(str(current_date))
+                    if entry and entry["status"] == "done" and entry["checksum"] == checksum:
+                        # this archive is already saved
+                        del attempts[current_date]
+                        msg = f"{current_date}: no change"
+                        if verbose:
+                            print(msg)
+                        logger.info(msg)
+                        continue
+                    if verbose:
+                        print(f"parsing archive of {current_date}")
+                    job = executor.submit(parse_archive, current_date, archive_path, r2d_index, batches,
+                                          read_batch_size)
+                    jobs[job] = (current_date, checksum)
+
+                # save batches while jobs are running, this also waits for downloads
+                _write_batches(batches, writer, timeout=0.1)
+                done = [job for job in jobs if job.done()]
+                if not done:
+                    continue
+                # all batches of finished jobs are in the queue now
+                _write_batches(batches, writer)
+                for job in done:
+                    current_date_, checksum = jobs.pop(job)
+                    attempt = attempts[current_date_]
+                    try:
+                        row_count = job.result()
+                    except Exception as exc:
+                        logger.exception(f"Archive {current_date_}, attempt {attempt}")
+                        retry_or_fail(current_date_, attempt, exc)
+                        continue
+                    entry = manifest.get(str(current_date_))
+                    # replace launches of the day if it was saved before
+                    writer.finish_day(current_date_, row_count, checksum,
+                                      attempt + ((entry["attempts"] or 0) if entry else 0),
+                                      replace=entry is not None and entry["status"] == "done")
+                    del attempts[current_date_]
+                    total_events += row_count
+                    msg = f"{current_date_}: {row_count} events"
                     if verbose:
                         print(msg)
                     logger.info(msg)
-                except Exception as exc:
-                    logger.exception(f"Archive {current_date_}")
-
-                del jobs[job]
-                # break to add a new job, if there is any
-                break
+    finally:
+        downloader.stop()
+    writer.flush()
 
     msg = f"{counter} files are parsed and {total_events} events are saved into the database"
     if verbose:
         print(msg)
     logger.info(msg)
 
-    # create indexes on launch table
-    # columns_to_index = ["timestamp", "origin", "provider", "resolved_ref", "ref", "repo_url"]
-    # db[launch_table].create_index(columns_to_index)
-    # optimize the database
-    db.vacuum()
+    if not incremental:
+        # optimize the database
+        # skip it in incremental mode, vacuum of a large database takes long
+        db.vacuum()
+
+    # create indexes on launch table after bulk load, in incremental mode they already exist
+    index_start_time = time()
+    for index_name, duration in build_launch_indexes(db):
+        msg = f"index {index_name} is built in {duration:.1f} seconds"
+        if verbose:
+            print(msg)
+        logger.info(msg)
+    msg = f"index build duration: {timedelta(seconds=time() - index_start_time)}"
+    if verbose:
+        print(msg)
+    logger.info(msg)
 
     end_time = datetime.now()
     msg = f"duration: {end_time-start_time}"
@@ -205,9 +446,38 @@ def get_args():
     parser.add_argument('-n', '--db_name', required=False, default="mybinder_archive",
                         help='Name of the output database, into where launch events are saved. '
                              'Default is mybinder_archive. '
-                             'Timestamp is always appended into the name.')
+                             'Timestamp is always appended into the name, except in incremental mode.')
     parser.add_argument('-m', '--max_workers', type=int, default=4, help='Max number of processes to run in parallel. '
                                                                          'Default is 4.')
+    parser.add_argument('-d', '--download_workers', type=int, default=DOWNLOAD_WORKERS,
+                        help='Max number of archives to download at the same time. '
+                             f'Default is {DOWNLOAD_WORKERS}.')
+    parser.add_argument('-p', '--prefetch', type=int, required=False, default=None,
+                        help='Max number of archives to download ahead of parsing. Default is 2 * max_workers.')
+    parser.add_argument('-b', '--write_batch_size', type=int, default=WRITE_BATCH_SIZE,
+                        help='Number of launches to insert into the database in one transaction. '
+                             f'Default is {WRITE_BATCH_SIZE}.')
+    parser.add_argument('--read_batch_size', type=int, default=READ_BATCH_SIZE,
+                        help='Number of events to read and parse at once, this limits memory usage of each worker. '
+                             f'Default is {READ_BATCH_SIZE}.')
+    parser.add_argument('-c', '--cache_dir', required=False, default=DEFAULT_CACHE_DIR,
+                        help='Folder where downloaded archive files are cached. '
+                             'Archives of past days are downloaded only once. '
+                             f'Default is {DEFAULT_CACHE_DIR}.')
+    parser.add_argument('-u', '--archive_url', required=False, default=ARCHIVE_URL,
+                        help=f'Base url of the events archive. Default is {ARCHIVE_URL}.')
+    parser.add_argument('-o', '--offline', required=False, default=False, action='store_true',
+                        help='Read archives only from the cache, without any network access. Default is False.')
+    parser.add_argument('--compact', required=False, default=False, action='store_true',
+                        help=f'Save launches in compact form: repeated values as ids of lookup tables and '
+                             f'timestamp as minutes since epoch. `{launch_table}` is then a view with the same columns. '
+                             f'This is only used when the database is created. Default is False.')
+    parser.add_argument('-i', '--incremental', required=False, default=False, action='store_true',
+                        help='Parse only archives which are missing or failed in the given database '
+                             '(and archive of today, if it is changed). The database is created if it doesnt exist. '
+                             'Default is False.')
+    parser.add_argument('-r', '--max_retries', type=int, default=MAX_RETRIES,
+                        help=f'Max number of attempts to parse an archive. Default is {MAX_RETRIES}.')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
                         help='Default is False.')
     args = parser.parse_args()
@@ -228,16 +498,23 @@ def main():
 
     _, script_ts_safe = get_utc_ts()
     db_name = args.db_name
-    db_name = f'{db_name}_at_{script_ts_safe}.db'.replace("-", "_")
+    incremental = args.incremental
+    if not incremental:
+        db_name = f'{db_name}_at_{script_ts_safe}.db'.replace("-", "_")
     max_workers = args.max_workers
     verbose = args.verbose
+    archive_cache = ArchiveCache(args.cache_dir, args.archive_url, args.offline)
 
     logger_name = f'{os.path.basename(__file__)[:-3]}_at_{script_ts_safe}'.replace("-", "_")
     logger = get_logger(logger_name)
     if verbose:
         print(f"Logs are in {logger_name}.log")
 
-    parse_mybinder_archive(start_date, end_date, db_name, max_workers, verbose)
+    parse_mybinder_archive(start_date, end_date, db_name, max_workers, verbose, archive_cache,
+                           write_batch_size=args.write_batch_size, incremental=incremental,
+                           max_retries=args.max_retries, read_batch_size=args.read_batch_size,
+                           compact=args.compact, download_workers=args.download_workers,
+                           prefetch=args.prefetch)
     print(f"""\n
     Launch events from {start_date} until {end_date} are saved into `{launch_table}` table in {db_name}.
     You can open this database with `sqlite3 {db_name}` command and then run any sqlite3 command, 
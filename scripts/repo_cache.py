@@ -0,0 +1,177 @@
+"""
+Local cache of bare mirrors of git repos, so a repo is cloned from remote only once
+and afterwards only new commits are fetched.
+Repo data (create_repo_table.py) and image builds (build_and_run_images.py) clone from these mirrors.
+
+Layout of the cache folder:
+
+    mirrors/<sha256[:2]>/<sha256>.git        bare mirror of a repo, named by hash of its repo_url
+    mirrors/<sha256[:2]>/<sha256>.git.lock   lock of the mirror: exclusive while fetching or removing,
+                                             shared while it is used
+    tmp/                                     clones from mirrors, on the same file system, so objects are hardlinked
+    index.db                                 `mirror` table: repo_url, path, size, fetched_at, last_used_at
+
+Total size of mirrors is kept under a disk budget by removing least recently used mirrors.
+"""
+import os
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_CACHE_DIR = "repo_cache"
+DEFAULT_MAX_SIZE_GB = 50
+INDEX_TABLE = "mirror"
+# only branches and tags as in a normal clone, e.g. refs/pull/* of GitHub are not fetched
+FETCH_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+
+def _git(command, cwd=None):
+    result = subprocess.run(command, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=cwd, env=dict(os.environ, GIT_TERMINAL_PROMPT="0"))
+    if result.returncode:
+        raise Exception(f"{command}: {result.stderr}")
+    return result
+
+
+def _get_size(path):
+    """returns size of a folder in bytes"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def _now():
+    return datetime.utcnow().replace(microsecond=0).isoformat()
+
+
+class RepoCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_gb=DEFAULT_MAX_SIZE_GB):
+        # only paths are kept, so the cache can be passed to worker processes
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.tmp_dir = os.path.join(self.cache_dir, "tmp")
+        self.index_path = os.path.join(self.cache_dir, "index.db")
+        os.makedirs(os.path.join(self.cache_dir, "mirrors"), exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        with self._index() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {INDEX_TABLE} ("
+                         f"repo_url TEXT PRIMARY KEY, path TEXT, size INTEGER, fetched_at TEXT, last_used_at TEXT);")
+
+    @contextmanager
+    def _index(self):
+        # a new connection for each operation, index is updated by many processes
+        conn = sqlite3.connect(self.index_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _mirror_path(self, repo_url):
+        key = hashlib.sha256(repo_url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, "mirrors", key[:2], f"{key}.git")
+
+    @contextmanager
+    def _lock(self, mirror_path, shared=False, block=True):
+        """flock of a mirror, raises BlockingIOError if block is False and mirror is locked"""
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        with open(f"{mirror_path}.lock", "a") as f:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not block:
+                flags |= fcntl.LOCK_NB
+            fcntl.flock(f, flags)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _is_cloned(mirror_path):
+        return os.path.exists(os.path.join(mirror_path, "HEAD"))
+
+    @staticmethod
+    def _has_commit(mirror_path, commit):
+        command = ["git", "cat-file", "-e", f"{commit}^{{commit}}"]
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=mirror_path)
+        return result.returncode == 0
+
+    def _update(self, repo_url, mirror_path):
+        """clones the mirror or fetches new commits into it, mirror must be locked exclusively"""
+        if not self._is_cloned(mirror_path):
+            # clone into tmp and then rename, so an interrupted clone is never used as mirror
+            tmp_path = tempfile.mkdtemp(dir=self.tmp_dir, suffix=".git")
+            try:
+                _git(["git", "clone", "--bare", "--quiet", repo_url, tmp_path])
+                for refspec in FETCH_REFSPECS:
+                    _git(["git", "config", "--add", "remote.origin.fetch", refspec], tmp_path)
+                shutil.rmtree(mirror_path, ignore_errors=True)
+                os.rename(tmp_path, mirror_path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            _git(["git", "fetch", "--quiet", "--prune", "origin"], mirror_path)
+            # default branch of the remote might be changed
+            result = _git(["git", "ls-remote", "--symref", "origin", "HEAD"], mirror_path)
+            if result.stdout.startswith("ref: "):
+                head = result.stdout[len("ref: "):].split("\t", 1)[0]
+                _git(["git", "symbolic-ref", "HEAD", head], mirror_path)
+        now = _now()
+        with self._index() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {INDEX_TABLE} VALUES (?, ?, ?, ?, ?);",
+                         (repo_url, os.path.relpath(mirror_path, self.cache_dir), _get_size(mirror_path), now, now))
+
+    @contextmanager
+    def mirror(self, repo_url, commit=None):
+        """
+        yields path of the mirror of repo_url, the mirror is not removed while it is used.
+        new commits are fetched from remote, unless the given commit is already in the mirror.
+        """
+        mirror_path = self._mirror_path(repo_url)
+        updated = False
+        while True:
+            with self._lock(mirror_path):
+                if not self._is_cloned(mirror_path) or not commit or not self._has_commit(mirror_path, commit):
+                    self._update(repo_url, mirror_path)
+                    updated = True
+            with self._lock(mirror_path, shared=True):
+                # mirror could be removed between the two locks
+                if self._is_cloned(mirror_path):
+                    with self._index() as conn:
+                        conn.execute(f"UPDATE {INDEX_TABLE} SET last_used_at=? WHERE repo_url=?;",
+                                     (_now(), repo_url))
+                    if updated:
+                        self.evict()
+                    yield mirror_path
+                    break
+
+    def evict(self):
+        """removes least recently used mirrors until total size is under the budget.
+        mirrors, which are in use, are skipped. returns number of removed mirrors."""
+        with self._index() as conn:
+            rows = conn.execute(f"SELECT repo_url, path, size FROM {INDEX_TABLE} ORDER BY last_used_at;").fetchall()
+        total_size = sum(row[2] for row in rows)
+        removed = 0
+        for repo_url, path, size in rows:
+            if total_size <= self.max_size:
+                break
+            mirror_path = os.path.join(self.cache_dir, path)
+            try:
+                with self._lock(mirror_path, block=False):
+                    shutil.rmtree(mirror_path, ignore_errors=True)
+                    with self._index() as conn:
+                        conn.execute(f"DELETE FROM {INDEX_TABLE} WHERE repo_url=?;", (repo_url,))
+            except BlockingIOError:
+                continue
+            total_size -= size
+            removed += 1
+        return removed
@@ -0,0 +1,51 @@
+"""
+Persistent cache of GitHub API responses, so repo data (create_repo_table.py) is revalidated
+with conditional requests instead of being fetched again in each run.
+
+A cached response is sent back with its `ETag` (`If-None-Match`) and `Last-Modified` (`If-Modified-Since`),
+GitHub answers with `304 Not Modified` if it didn't change and 304 responses don't count against the rate limit.
+https://docs.github.com/en/rest/overview/resources-in-the-rest-api#conditional-requests
+
+Responses are kept in `response` table of a sqlite database: url, etag, last_modified, body, fetched_at.
+Only successful (200) responses are cached.
+"""
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_CACHE_PATH = "github_responses.db"
+RESPONSE_TABLE = "response"
+
+
+class ResponseCache:
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH):
+        # only path is kept, so the cache can be passed to worker processes
+        self.cache_path = cache_path
+        with self._db() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {RESPONSE_TABLE} ("
+                         f"url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body TEXT, fetched_at TEXT);")
+
+    @contextmanager
+    def _db(self):
+        # a new connection for each operation, cache is updated by many processes
+        conn = sqlite3.connect(self.cache_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, url):
+        """returns (etag, last_modified, body) of the cached response of url or None"""
+        with self._db() as conn:
+            return conn.execute(f"SELECT etag, last_modified, body FROM {RESPONSE_TABLE} WHERE url=?;",
+                                (url,)).fetchone()
+
+    def set(self, url, etag, last_modified, body):
+        if not etag and not last_modified:
+            # response can't be revalidated
+            return
+        with self._db() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {RESPONSE_TABLE} (url, etag, last_modified, body, fetched_at) "
+                         f"VALUES (?, ?, ?, ?, ?);",
+                         (url, etag, last_modified, body, datetime.utcnow().replace(microsecond=0).isoformat()))
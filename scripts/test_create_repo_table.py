@@ -0,0 +1,78 @@
+"""
+Tests of GitHub API error handling of create_repo_table.py against the local stub (github_api_stub.py).
+
+    cd scripts && python -m pytest test_create_repo_table.py
+"""
+import time
+import logging
+import pytest
+import create_repo_table as crt
+from github_api_stub import serve_github_api, GithubAPIStubHandler
+from response_cache import ResponseCache
+from token_pool import TokenPool
+from utils import _is_rate_limited
+
+REPOS = {
+    "org/repo": {"id": 1, "fork": False, "default_branch": "main"},
+    "org/forbidden": {"status": 403},
+    "org/blocked": {"status": 451},
+}
+
+
+@pytest.fixture
+def api_url(monkeypatch):
+    monkeypatch.setattr(crt, "logger", logging.getLogger("test_create_repo_table"), raising=False)
+    monkeypatch.setattr(crt, "verbose", False, raising=False)
+    # no backoff and no clones in tests
+    monkeypatch.setattr(crt, "sleep", lambda seconds: None)
+    monkeypatch.setattr(crt, "get_repo_data_from_git",
+                        lambda ref, repo_url, blobless=False, repo_cache=None: {"resolved_ref": "abc"})
+    server = serve_github_api(REPOS)
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def _repo_entry(full_name):
+    return {"provider": "GitHub", "repo_url": f"https://github.com/{full_name}",
+            "last_spec": f"{full_name}/main", "fork": None}
+
+
+def test_is_rate_limited():
+    assert _is_rate_limited(403, {"message": "API rate limit exceeded"}, 10)
+    assert _is_rate_limited(403, {"message": "You have exceeded a secondary rate limit"})
+    assert _is_rate_limited(403, {"message": "Repository access blocked"}, 0)
+    assert not _is_rate_limited(403, {"message": "Repository access blocked"}, 10)
+    assert not _is_rate_limited(451, {"message": "API rate limit exceeded"}, 0)
+
+
+@pytest.mark.parametrize("cached", [False, True])
+@pytest.mark.parametrize("full_name, status", [("org/forbidden", 403), ("org/blocked", 451)])
+def test_blocked_repo(api_url, tmp_path, cached, full_name, status):
+    """blocked repos are retried a limited number of times and dont block the token"""
+    token_pool = TokenPool(["token"])
+    response_cache = ResponseCache(str(tmp_path / "responses.db")) if cached else None
+    start = time.time()
+    repo_entry = crt.get_repo_data(_repo_entry(full_name), token_pool, api_url=api_url,
+                                   response_cache=response_cache)
+    assert repo_entry["fork"] == status
+    assert repo_entry.get("remote_id") is None
+    # token can be used without waiting for a reset
+    assert token_pool.acquire("core") == ("token", 0)
+    repo_entry = crt.get_repo_data(_repo_entry("org/repo"), token_pool, api_url=api_url,
+                                   response_cache=response_cache)
+    assert repo_entry["fork"] == 0 and repo_entry["remote_id"] == 1 and repo_entry["resolved_ref"] == "abc"
+    assert time.time() - start < 10
+
+
+def test_rate_limited_repo(api_url, tmp_path, monkeypatch):
+    """a 403 of an exceeded rate limit blocks the token until the reset"""
+    monkeypatch.setattr(GithubAPIStubHandler, "rate_limit", 0)
+    token_pool = TokenPool(["token"])
+    # with response cache, because PyGithub might wait for the reset itself
+    with pytest.raises(crt.RateLimitExceededException):
+        crt.get_repo_data_from_github_api("GitHub", "https://github.com/org/repo", api_url=api_url,
+                                          token_pool=token_pool,
+                                          response_cache=ResponseCache(str(tmp_path / "responses.db")))
+    token, wait_seconds = token_pool.acquire("core")
+    assert token is None and wait_seconds > 0
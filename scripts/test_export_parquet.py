@@ -0,0 +1,81 @@
+"""
+Tests that files written by export_parquet.py are read back by analysis/parquet_loader.py.
+
+    cd scripts && python -m pytest test_export_parquet.py
+"""
+import os
+import sys
+import logging
+import pandas as pd
+import pytest
+from sqlite_utils import Database
+import export_parquet as ep
+from launch_db import LaunchWriter, create_manifest_table, df_to_rows, get_launch_rollups
+from utils import REPO_TABLE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "analysis"))
+from parquet_loader import load_launches, load_repos  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def export_globals(monkeypatch):
+    monkeypatch.setattr(ep, "logger", logging.getLogger("test_export_parquet"), raising=False)
+    monkeypatch.setattr(ep, "verbose", False, raising=False)
+
+
+def _launches(archive_date, repo_count):
+    """launches of an archive day, one launch per repo"""
+    return pd.DataFrame([{
+        "timestamp": f"{archive_date}T10:00:00", "version": 3, "origin": "gke.mybinder.org", "provider": "GitHub",
+        "spec": f"org{i}/repo{i}/master", "org": f"org{i}", "ref": "master",
+        # resolved_ref of old launches is null
+        "resolved_ref": "abc" if repo_count > 100 else None,
+        "r2d_version": "r2d-1", "repo_url": f"https://github.com/org{i}/repo{i}",
+    } for i in range(repo_count)])
+
+
+def _create_db(db_name, days):
+    db = Database(db_name)
+    create_manifest_table(db)
+    writer = LaunchWriter(db)
+    for archive_date, repo_count in days.items():
+        df = _launches(archive_date, repo_count)
+        writer.add(archive_date, df_to_rows(df), get_launch_rollups(df))
+        writer.finish_day(archive_date, len(df), f"checksum-{archive_date}")
+    writer.flush()
+    return db
+
+
+@pytest.mark.parametrize("days", [
+    # int8 indices of categories in first file, more than 127 categories in the second one
+    {"2020-01-01": 3, "2020-01-02": 600},
+    {"2020-01-01": 600, "2020-01-02": 3},
+])
+def test_load_launches(tmp_path, days):
+    db_name = str(tmp_path / "launches.db")
+    output_dir = str(tmp_path / "parquet")
+    _create_db(db_name, days)
+    ep.export_parquet(db_name, output_dir)
+    df = load_launches(output_dir)
+    assert len(df) == sum(days.values())
+    assert df["repo_url"].nunique() == max(days.values())
+    assert df["resolved_ref"].notna().sum() == 600
+
+
+def test_load_repos(tmp_path):
+    db_name = str(tmp_path / "repos.db")
+    output_dir = str(tmp_path / "parquet")
+    db = _create_db(db_name, {"2020-01-01": 3, "2020-02-01": 300})
+    repos = []
+    for i in range(300):
+        month = "2020-01" if i < 3 else "2020-02"
+        # repos of first month are not fetched yet
+        repos.append({"id": i + 1, "repo_url": f"https://github.com/org{i}/repo{i}", "provider": "GitHub",
+                      "first_launch_ts": f"{month}-01T10:00:00", "fork": None if i < 3 else 0,
+                      "buildpack": None if i < 3 else f"BuildPack{i}"})
+    db[REPO_TABLE].insert_all(repos, pk="id", columns={"fork": int, "buildpack": str})
+    ep.export_parquet(db_name, output_dir)
+    df = load_repos(output_dir)
+    assert len(df) == 300
+    assert df["buildpack"].notna().sum() == 297
+    assert len(load_repos(output_dir, start_month="2020-01", end_month="2020-01")) == 3
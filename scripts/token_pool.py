@@ -0,0 +1,101 @@
+"""
+Rate limit budget of GitHub access tokens, which is shared by all worker processes.
+
+The pool runs in a manager process (`start_token_pool`), workers get a proxy of it.
+Before each API call a worker takes a token with `get_token`, tokens are used round-robin
+and a worker waits only if all tokens are exhausted, until the earliest reset.
+After each response the budget of the token is updated from its rate limit headers.
+
+Core (REST) and GraphQL rate limits of a token are separate resources.
+"""
+import time
+import threading
+from multiprocessing.managers import BaseManager
+
+# wait after a 403 without a rate limit reset (e.g. secondary rate limits)
+DEFAULT_BLOCK_SECONDS = 60
+
+
+class TokenPool:
+    def __init__(self, tokens):
+        self.tokens = [t for t in tokens if t]
+        if not self.tokens:
+            raise Exception("token pool needs at least one token")
+        # {(token, resource): [remaining, reset_ts]}, unknown until first response of the token
+        self.budgets = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, resource="core"):
+        """returns (token, 0) of the next token with budget and reserves one call of it,
+        or (None, seconds) to wait until budget of a token is reset"""
+        with self.lock:
+            now = time.time()
+            wait_seconds = None
+            for i in range(len(self.tokens)):
+                index = (self.next_index + i) % len(self.tokens)
+                token = self.tokens[index]
+                budget = self.budgets.get((token, resource))
+                if budget is not None and budget[1] <= now:
+                    # rate limit window is reset, budget is unknown until next response
+                    del self.budgets[(token, resource)]
+                    budget = None
+                if budget is None or budget[0] > 0:
+                    if budget is not None:
+                        budget[0] -= 1
+                    self.next_index = (index + 1) % len(self.tokens)
+                    return token, 0
+                seconds = budget[1] - now
+                wait_seconds = seconds if wait_seconds is None else min(wait_seconds, seconds)
+            return None, wait_seconds
+
+    def update(self, token, resource, remaining, reset_ts):
+        """sets budget of a token from rate limit headers of a response"""
+        with self.lock:
+            budget = self.budgets.get((token, resource))
+            if budget is not None and budget[1] == reset_ts:
+                # responses of parallel calls arrive in any order,
+                # in the same window the lowest remaining is the latest
+                remaining = min(remaining, budget[0])
+            self.budgets[(token, resource)] = [remaining, reset_ts]
+
+    def exhausted(self, token, resource, reset_ts=None):
+        """marks a token as exhausted after a 403 response"""
+        if not reset_ts or reset_ts <= time.time():
+            # e.g. secondary rate limits
+            reset_ts = time.time() + DEFAULT_BLOCK_SECONDS
+        with self.lock:
+            self.budgets[(token, resource)] = [0, reset_ts]
+
+    def get_remaining(self):
+        """returns {resource: remaining calls of all tokens with known budget}"""
+        with self.lock:
+            remaining = {}
+            for (_, resource), budget in self.budgets.items():
+                remaining[resource] = remaining.get(resource, 0) + max(budget[0], 0)
+            return remaining
+
+
+class TokenPoolManager(BaseManager):
+    pass
+
+
+TokenPoolManager.register("TokenPool", TokenPool)
+
+
+def start_token_pool(tokens):
+    """starts a manager process with a token pool,
+    returns (manager, pool proxy). proxy can be passed to worker processes."""
+    manager = TokenPoolManager()
+    manager.start()
+    return manager, manager.TokenPool(tokens)
+
+
+def get_token(token_pool, resource="core"):
+    """returns a token with budget, blocks until budget of a token is reset if all are exhausted"""
+    while True:
+        token, wait_seconds = token_pool.acquire(resource)
+        if token is not None:
+            return token
+        # small margin, GitHub resets a bit after the reset time
+        time.sleep(wait_seconds + 1)
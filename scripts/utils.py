@@ -1,13 +1,18 @@
+import io
+import re
 import logging
 import time
+import posixpath
 import requests
 import subprocess
 import tempfile
 import signal
 import os
-from datetime import datetime
+import json
+from datetime import datetime, date
+from xml.etree import ElementTree
 from yaml import safe_load
-from github import Github, GithubException
+from github import Github, GithubException, RateLimitExceededException
 from urllib.parse import unquote
 from sqlite_utils import Database
 from binderhub.repoproviders import strip_suffix, GitHubRepoProvider, GitRepoProvider, \
@@ -17,13 +22,19 @@ from binderhub.builder import _safe_build_slug
 from repo2docker.buildpacks import CondaBuildPack, DockerBuildPack, JuliaProjectTomlBuildPack, JuliaRequireBuildPack, \
     LegacyBinderDockerBuildPack, NixBuildPack, PipfileBuildPack, PythonBuildPack, RBuildPack
 from repo2docker.utils import chdir
+from token_pool import get_token
 
 LAUNCH_TABLE = "mybinderlaunch"
 REPO_TABLE = "repo"
 EXECUTION_TABLE = "execution"
+INGEST_MANIFEST_TABLE = "ingest_manifest"
 
 DEFAULT_IMAGE_PREFIX = "bp20-"
 
+GITHUB_API_URL = "https://api.github.com"
+# max number of repos in one GraphQL request, it costs 1 point of rate limit
+GRAPHQL_BATCH_SIZE = 100
+
 BUILDPACKS = [
     LegacyBinderDockerBuildPack,
     DockerBuildPack,
@@ -36,6 +47,23 @@ BUILDPACKS = [
     PythonBuildPack
 ]
 
+# files which are read by detect() of BUILDPACKS, in the root folder or in the binder folder
+DETECT_FILES = [
+    "Dockerfile",
+    "environment.yml",
+    "Project.toml",
+    "JuliaProject.toml",
+    "REQUIRE",
+    "default.nix",
+    "runtime.txt",
+    "DESCRIPTION",
+    "Pipfile",
+    "Pipfile.lock",
+    "requirements.txt",
+    "setup.py",
+]
+BINDER_DIRS = ["binder", ".binder"]
+
 
 REPO_PROVIDERS = {
     'GitHub': GitHubRepoProvider,
@@ -171,10 +199,264 @@ def git_execute(command, cwd=None, env=None):
     return result
 
 
-def get_repo_data_from_git(ref, repo_url):
+def detect_buildpack(repo_dir):
+    """
+    uses repo2docker to detect binder_dir and buildpack of a checked out repo
+    """
+    default_buildpack = PythonBuildPack
+    with chdir(repo_dir):
+        for BP in BUILDPACKS:
+            bp = BP()
+            try:
+                if bp.detect():
+                    picked_buildpack = bp
+                    break
+            except RuntimeError as e:
+                if "The legacy buildpack has been removed." == e.args[0]:
+                    picked_buildpack = LegacyBinderDockerBuildPack()
+                    setattr(picked_buildpack, "binder_dir", "")
+                    break
+                else:
+                    raise e
+        else:
+            picked_buildpack = default_buildpack()
+
+        return picked_buildpack.binder_dir, picked_buildpack.__class__.__name__
+
+
+def resolve_ref(ref, repo_dir):
+    """
+    returns commit hash of ref in a cloned repo (without checkout) or None if ref doesnt exist.
+    refs are resolved as `git checkout <ref>` does: first as a commit-ish (sha, tag, local branch)
+    and then as a remote branch.
+    """
+    for rev in [ref, f"origin/{ref}"]:
+        command = ["git", "rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"]
+        try:
+            result = git_execute(command, repo_dir)
+        except Exception:
+            continue
+        return result.stdout.strip()
+    return None
+
+
+def get_git_tree(resolved_ref, repo_dir):
+    """
+    returns all entries (files, folders, symlinks and submodules) of the tree of resolved_ref
+    as {path: (mode, type, object)}
+    """
+    # -z: paths are not quoted and entries are separated by NUL
+    command = ["git", "ls-tree", "-r", "-t", "-z", "--full-tree", resolved_ref]
+    result = git_execute(command, repo_dir)
+    return _parse_git_tree(result.stdout)
+
+
+def _parse_git_tree(output):
+    """parses output of `git ls-tree -z` into {path: (mode, type, object)}"""
+    tree = {}
+    for entry in output.split("\0"):
+        if not entry:
+            continue
+        # <mode> SP <type> SP <object> TAB <path>
+        info, path = entry.split("\t", 1)
+        mode, type_, object_ = info.split()
+        tree[path] = (mode, type_, object_)
+    return tree
+
+
+def checkout_detect_files(tree, resolved_ref, repo_dir):
+    """
+    checks out only the files which are inspected by detect() of BUILDPACKS (DETECT_FILES in root and in binder
+    folders) from a clone without checkout. in a blobless clone only blobs of these files are downloaded.
+    returns False if detection needs the whole tree (e.g. for symlinks or stencila manifest.xml files),
+    then nothing is checked out.
+    """
+    detect_paths = _get_detect_paths(tree)
+    if detect_paths is None:
+        return False
+    paths, dirs = detect_paths
+    for dir_ in dirs:
+        os.makedirs(os.path.join(repo_dir, dir_), exist_ok=True)
+    if paths:
+        command = ["git", "checkout", resolved_ref, "--", *paths]
+        git_execute(command, repo_dir)
+    return True
+
+
+def _get_detect_paths(tree):
+    """returns (files, folders) in tree which are inspected by detect() of BUILDPACKS
+    or None if detection needs the whole tree"""
+    paths = []
+    dirs = []
+    for path, (mode, type_, _) in tree.items():
+        parent, _, name = path.rpartition("/")
+        if name == "manifest.xml":
+            # RBuildPack looks for stencila manifest.xml files in whole repo
+            return None
+        if path in BINDER_DIRS or (parent in ["", *BINDER_DIRS] and name in DETECT_FILES):
+            if mode == "120000":
+                # symlink, its target might not be checked out
+                return None
+            if type_ == "blob":
+                paths.append(path)
+            else:
+                # folders (and submodules) must exist too, e.g. for binder_dir
+                dirs.append(path)
+    return paths, dirs
+
+
+class UndecidedTree(Exception):
+    """buildpack can't be detected from the tree listing, e.g. because of a symlink"""
+
+
+def _get_tree_entry(tree, path):
+    """returns (mode, type, object) of path or None if it doesnt exist"""
+    parts = path.split("/")
+    for i in range(1, len(parts) + 1):
+        entry = tree.get("/".join(parts[:i]))
+        if entry is not None and entry[0] == "120000":
+            # os.path functions follow symlinks
+            raise UndecidedTree(f"{path}: symlink")
+    return tree.get(path)
+
+
+def _tree_exists(tree, path):
+    return _get_tree_entry(tree, path) is not None
+
+
+def _tree_isdir(tree, path):
+    entry = _get_tree_entry(tree, path)
+    # submodules are empty folders in a checkout
+    return entry is not None and entry[1] in ["tree", "commit"]
+
+
+def _read_tree_file(tree, path, repo_dir, text=True):
+    """returns content of a file as open(path).read() would return.
+    in a blobless clone the blob is downloaded here."""
+    entry = _get_tree_entry(tree, path)
+    if entry is None:
+        raise FileNotFoundError(path)
+    if entry[1] != "blob":
+        raise UndecidedTree(f"{path}: not a file")
+    result = subprocess.run(["git", "cat-file", "blob", entry[2]], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=repo_dir)
+    if result.returncode:
+        raise Exception(f"git cat-file blob {entry[2]}: {result.stderr.decode()}")
+    if not text:
+        return result.stdout
+    # same encoding and universal newlines as open()
+    return io.TextIOWrapper(io.BytesIO(result.stdout)).read()
+
+
+def _get_stencila_contexts(tree, repo_dir):
+    """RBuildPack.stencila_contexts: code languages of the first document in the first stencila manifest.xml"""
+    manifests = [path for path, (_, type_, _) in tree.items()
+                 if type_ == "blob" and path.rpartition("/")[2] == "manifest.xml"]
+    if not manifests:
+        return set()
+    if len(manifests) > 1:
+        # repo2docker takes the first one which os.walk finds, that depends on the file system
+        raise UndecidedTree("multiple manifest.xml")
+    manifest_dir = manifests[0].rpartition("/")[0]
+    if not manifest_dir:
+        # repo2docker fails for a manifest.xml in root folder
+        raise UndecidedTree("manifest.xml in root")
+    manifest = ElementTree.fromstring(_read_tree_file(tree, manifests[0], repo_dir, text=False))
+    for document in manifest.findall("./documents/document"):
+        path = document.get("path")
+        if path is None:
+            raise UndecidedTree("document without path")
+        path = posixpath.normpath(posixpath.join(manifest_dir, path))
+        if path.startswith("/") or path.startswith("../"):
+            raise UndecidedTree(f"{path}: outside of repo")
+        document = ElementTree.fromstring(_read_tree_file(tree, path, repo_dir, text=False))
+        code_chunks = document.findall('.//code[@specific-use="source"]')
+        return set(x.get("language") for x in code_chunks)
+    return set()
+
+
+def detect_buildpack_from_tree(tree, repo_dir):
+    """
+    detects binder_dir and buildpack as `detect_buildpack` does, but from the tree listing (`get_git_tree`)
+    and the contents of only a few blobs (root Dockerfile, runtime.txt, stencila files), without a checkout.
+    detect() methods of BUILDPACKS (repo2docker 0.11) are re-implemented here in the same order,
+    `validate_tree_detection.py` compares both on a fixture corpus.
+    returns None if it can't be decided from the tree, then `detect_buildpack` must be used.
+    """
+    try:
+        # LegacyBinderDockerBuildPack reads Dockerfile in root folder
+        try:
+            dockerfile = _read_tree_file(tree, "Dockerfile", repo_dir)
+        except FileNotFoundError:
+            dockerfile = ""
+        for line in io.StringIO(dockerfile):
+            if line.startswith("FROM"):
+                if "andrewosh/binder-base" in line.split("#")[0].lower():
+                    return "", "LegacyBinderDockerBuildPack"
+                break
+
+        has_binder = _tree_isdir(tree, "binder")
+        has_dotbinder = _tree_isdir(tree, ".binder")
+        if has_binder and has_dotbinder:
+            raise RuntimeError("The repository contains both a 'binder' and a '.binder' "
+                               "directory. However they are exclusive.")
+        binder_dir = ".binder" if has_dotbinder else "binder" if has_binder else ""
+
+        def exists(path):
+            return _tree_exists(tree, posixpath.join(binder_dir, path))
+
+        if exists("Dockerfile"):
+            return binder_dir, "DockerBuildPack"
+        if exists("Project.toml") or exists("JuliaProject.toml"):
+            return binder_dir, "JuliaProjectTomlBuildPack"
+        if exists("REQUIRE"):
+            return binder_dir, "JuliaRequireBuildPack"
+        if exists("default.nix"):
+            return binder_dir, "NixBuildPack"
+        # runtime.txt is read by RBuildPack, PipfileBuildPack and PythonBuildPack
+        try:
+            runtime = _read_tree_file(tree, posixpath.join(binder_dir, "runtime.txt"), repo_dir).strip()
+        except FileNotFoundError:
+            runtime = None
+        match = re.match(r"r-(\d.\d(.\d)?-)?(\d\d\d\d)-(\d\d)-(\d\d)", runtime or "")
+        if match:
+            # raises ValueError for invalid dates as RBuildPack
+            date(*[int(s) for s in match.groups()[-3:]])
+            return binder_dir, "RBuildPack"
+        if (not binder_dir and _tree_exists(tree, "DESCRIPTION")) or "r" in _get_stencila_contexts(tree, repo_dir):
+            return binder_dir, "RBuildPack"
+        if exists("environment.yml"):
+            return binder_dir, "CondaBuildPack"
+        if (runtime is None or runtime.startswith("python-")) and (exists("Pipfile") or exists("Pipfile.lock")):
+            return binder_dir, "PipfileBuildPack"
+        # PythonBuildPack is also the default
+        return binder_dir, "PythonBuildPack"
+    except UndecidedTree:
+        return None
+
+
+def _is_unknown_ref_error(e, ref):
+    """returns True if `git checkout <ref>` failed, because ref doesnt exist in the repo"""
+    e_txt = e.args[0].strip()
+    return f"error: pathspec '{ref}' did not match any file(s) known to git" in e_txt or \
+        "fatal: reference is not a tree" in e_txt
+
+
+def _to_utc_isoformat(commit_date):
+    date_ = datetime.fromisoformat(commit_date)
+    # have date in UTC and in isoformat
+    # this also removes timezone info
+    return datetime.utcfromtimestamp(date_.timestamp()).isoformat()
+
+
+def get_repo_data_from_git(ref, repo_url, blobless=False, repo_cache=None):
     """
     - get commit date of resolved ref from git history
     - use repo2docker to detect binder_dir and buildpack
+
+    if blobless is True, repo is cloned without file contents (blobs) and without checkout
+    and the buildpack is detected from the tree listing and only a few blobs.
+    if a repo_cache (repo_cache.RepoCache) is given, repo is cloned from its local mirror.
     """
     repo_data = {
         "resolved_date": datetime.utcnow().replace(second=0, microsecond=0).isoformat(),
@@ -183,97 +465,193 @@ def get_repo_data_from_git(ref, repo_url):
         "binder_dir": None,
         "buildpack": None,
     }
-    with tempfile.TemporaryDirectory() as tmp_dir_path:
-        command = ["git", "clone", repo_url, tmp_dir_path]
-        git_execute(command, env={"GIT_TERMINAL_PROMPT": "0"})
-
-        # check if resolved ref exists in repo
-        # it is possible that a commit, which is launched, is removed from history
-        # ex: https://github.com/vaughnkoch/test1 and
-        # https://github.com/vaughnkoch/test1/commit/464062f227e35eea5d01e138b83bb01912587060
-        command = ["git", "checkout", ref]
-        try:
-            git_execute(command, tmp_dir_path)
-        except Exception as e:
-            e_txt = e.args[0].strip()
-            if f"error: pathspec '{ref}' did not match any file(s) known to git" in e_txt or \
-                "fatal: reference is not a tree" in e_txt:
+    # clones from mirrors are on the same file system as the cache
+    tmp_root = repo_cache.tmp_dir if repo_cache is not None else None
+    with tempfile.TemporaryDirectory(dir=tmp_root) as tmp_dir_path:
+        if repo_cache is not None:
+            with repo_cache.mirror(repo_url) as mirror_path:
+                # local clone, objects are hardlinked, so there is no need for a blob filter
+                command = ["git", "clone", mirror_path, tmp_dir_path]
+                if blobless:
+                    command.insert(2, "--no-checkout")
+                git_execute(command)
+        else:
+            if blobless:
+                # history (commits and trees) without blobs, servers which dont support filters send a full clone
+                command = ["git", "clone", "--filter=blob:none", "--no-checkout", repo_url, tmp_dir_path]
+            else:
+                command = ["git", "clone", repo_url, tmp_dir_path]
+            git_execute(command, env={"GIT_TERMINAL_PROMPT": "0"})
+
+        if blobless:
+            resolved_ref = resolve_ref(ref, tmp_dir_path)
+            if resolved_ref is None:
+                # same as below, when ref doesnt exist in the repo
                 repo_data["resolved_ref"] = "404"
-                # repo_data["resolved_ref_date"] = "404"
-                # repo_data["binder_dir"] = "404"
-                # repo_data["buildpack"] = "404"
                 return repo_data
-            else:
-                raise e
         else:
+            # check if resolved ref exists in repo
+            # it is possible that a commit, which is launched, is removed from history
+            # ex: https://github.com/vaughnkoch/test1 and
+            # https://github.com/vaughnkoch/test1/commit/464062f227e35eea5d01e138b83bb01912587060
+            command = ["git", "checkout", ref]
+            try:
+                git_execute(command, tmp_dir_path)
+            except Exception as e:
+                if _is_unknown_ref_error(e, ref):
+                    repo_data["resolved_ref"] = "404"
+                    # repo_data["resolved_ref_date"] = "404"
+                    # repo_data["binder_dir"] = "404"
+                    # repo_data["buildpack"] = "404"
+                    return repo_data
+                else:
+                    raise e
             command = ["git", "rev-parse", "HEAD"]
             result = git_execute(command, tmp_dir_path)
             resolved_ref = result.stdout.strip()
-            repo_data["resolved_ref"] = resolved_ref
+        repo_data["resolved_ref"] = resolved_ref
 
-            # get commit date of resolved ref
-            command = ["git", "show", "-s", "--format=%cI", resolved_ref]
-            result = git_execute(command, tmp_dir_path)
-            resolved_ref_date = result.stdout.strip()
-            date_ = datetime.fromisoformat(resolved_ref_date)
-            # have date in UTC and in isoformat
-            # this also removes timezone info
-            repo_data["resolved_ref_date"] = datetime.utcfromtimestamp(date_.timestamp()).isoformat()
-
-            default_buildpack = PythonBuildPack
-            with chdir(tmp_dir_path):
-                for BP in BUILDPACKS:
-                    bp = BP()
-                    try:
-                        if bp.detect():
-                            picked_buildpack = bp
-                            break
-                    except RuntimeError as e:
-                        if "The legacy buildpack has been removed." == e.args[0]:
-                            picked_buildpack = LegacyBinderDockerBuildPack()
-                            setattr(picked_buildpack, "binder_dir", "")
-                            break
-                        else:
-                            raise e
-                else:
-                    picked_buildpack = default_buildpack()
-
-                repo_data["binder_dir"] = picked_buildpack.binder_dir
-                repo_data["buildpack"] = picked_buildpack.__class__.__name__
+        # get commit date of resolved ref
+        command = ["git", "show", "-s", "--format=%cI", resolved_ref]
+        result = git_execute(command, tmp_dir_path)
+        repo_data["resolved_ref_date"] = _to_utc_isoformat(result.stdout.strip())
+
+        detected = None
+        if blobless:
+            # detect from tree listing and if it is not possible, check out only the necessary files
+            tree = get_git_tree(resolved_ref, tmp_dir_path)
+            detected = detect_buildpack_from_tree(tree, tmp_dir_path)
+            if detected is None and not checkout_detect_files(tree, resolved_ref, tmp_dir_path):
+                command = ["git", "checkout", resolved_ref]
+                git_execute(command, tmp_dir_path)
+        if detected is None:
+            detected = detect_buildpack(tmp_dir_path)
+        repo_data["binder_dir"], repo_data["buildpack"] = detected
     return repo_data
 
 
-def get_repo_data_from_github_api(provider, repo_url, access_token=None):
+def _get_minutes_until_reset(reset_ts):
+    reset_seconds = reset_ts - time.time()
+    # round expiry up to nearest 5 minutes (as it is done in bhub)
+    return 5 * (1 + (reset_seconds // 60 // 5))
+
+
+def _is_rate_limited(status, data, remaining=None):
+    """returns True if a 403 (or 429) response is caused by a rate limit (primary or secondary),
+    other 403 responses are e.g. repos which are blocked or forbidden"""
+    if status not in [403, 429]:
+        return False
+    if remaining == 0:
+        return True
+    message = data.get("message") if isinstance(data, dict) else data
+    return "rate limit" in str(message or "").lower()
+
+
+def _get_rate_limit(g):
+    """returns (remaining, reset_ts) of core rate limit from the last response of PyGithub or None.
+    if the rate limit is not known yet (e.g. first request failed), PyGithub requests it"""
+    try:
+        remaining, _ = g.rate_limiting
+        return remaining, g.rate_limiting_resettime
+    except GithubException:
+        # an error of this request must not replace the error of the repo
+        return None
+
+
+def _get_github_json(url, access_token, response_cache):
+    """
+    GET request to GitHub REST API, which revalidates the cached response (response_cache.ResponseCache) of url
+    with a conditional request.
+    returns (status, data, (remaining, reset_ts) or None), data of a 304 response is the cached one.
+    """
+    headers = {"Accept": "application/vnd.github.v3+json"}
+    if access_token:
+        headers["Authorization"] = f"token {access_token}"
+    cached = response_cache.get(url)
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    response = requests.get(url, headers=headers, timeout=60)
+    rate_limit = None
+    if "X-RateLimit-Remaining" in response.headers:
+        rate_limit = int(response.headers["X-RateLimit-Remaining"]), int(response.headers["X-RateLimit-Reset"])
+    if response.status_code == 304:
+        return 200, json.loads(cached[2]), rate_limit
+    try:
+        data = response.json()
+    except ValueError:
+        data = {"message": response.text}
+    if response.status_code == 200:
+        response_cache.set(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), response.text)
+    return response.status_code, data, rate_limit
+
+
+def get_repo_data_from_github_api(provider, repo_url, access_token=None, api_url=GITHUB_API_URL, token_pool=None,
+                                  response_cache=None):
+    """
+    if a token_pool (token_pool.TokenPool) is given, access_token is taken from the pool
+    and the pool is updated with the rate limit of the response.
+    if a response_cache (response_cache.ResponseCache) is given, cached responses are revalidated with
+    conditional requests, which don't count against the rate limit when repo is not modified.
+    """
     if provider not in REPO_PROVIDERS:
         raise Exception(f"unknown provider: {provider}")
 
     if provider in ["GitHub", "Gist"]:
-        repo_data = {"remote_id": None, "fork": None}
+        repo_data = {"remote_id": None, "fork": None, "default_branch": None}
+        if token_pool is not None:
+            access_token = get_token(token_pool, "core")
+        if provider == "GitHub":
+            # github repo url is in this form: "https://github.com/{self.user}/{self.repo}"
+            full_name = repo_url.split("github.com/")[-1]
+            path = f"repos/{full_name}"
+        else:
+            path = f'gists/{repo_url.split("/")[-1]}'
+        g = Github(access_token, base_url=api_url)
+        rate_limit = None
         try:
-            g = Github(access_token)
-            if provider == "GitHub":
-                # github repo url is in this form: "https://github.com/{self.user}/{self.repo}"
-                full_name = repo_url.split("github.com/")[-1]
-                repo = g.get_repo(f"{full_name}")
+            if response_cache is not None:
+                status, repo, rate_limit = _get_github_json(f"{api_url.rstrip('/')}/{path}", access_token,
+                                                            response_cache)
+                if status != 200:
+                    raise GithubException(status, repo)
+            elif provider == "GitHub":
+                repo = g.get_repo(f"{full_name}").raw_data
             else:
-                repo = g.get_gist(f'{repo_url.split("/")[-1]}')
-            # we need remote_id to detect renamed repos/users
-            repo_data["remote_id"] = repo.id
+                repo = g.get_gist(f'{repo_url.split("/")[-1]}').raw_data
         except GithubException as e:
+            if response_cache is None:
+                rate_limit = _get_rate_limit(g)
+            rate_limited = _is_rate_limited(e.status, e.data, rate_limit[0] if rate_limit else None)
+            if token_pool is not None:
+                # token is blocked only by a rate limit, not by a blocked repo
+                if rate_limited:
+                    token_pool.exhausted(access_token, "core", rate_limit[1] if rate_limit else None)
+                elif rate_limit is not None:
+                    token_pool.update(access_token, "core", *rate_limit)
             if e.status == 404:
                 # repo doesnt exists anymore
                 repo_data["fork"] = 404
                 return repo_data
-            elif e.status == 403:
-                reset_seconds = g.rate_limiting_resettime - time.time()
-                # round expiry up to nearest 5 minutes (as it is done in bhub)
-                minutes_until_reset = 5 * (1 + (reset_seconds // 60 // 5))
-                e.data["minutes_until_reset"] = minutes_until_reset
-                raise e
+            elif rate_limited:
+                data = e.data if isinstance(e.data, dict) else {"message": e.data}
+                data["minutes_until_reset"] = _get_minutes_until_reset(rate_limit[1] if rate_limit else time.time())
+                raise RateLimitExceededException(e.status, data)
             else:
                 raise e
-        if getattr(repo, "fork", None) or getattr(repo, "fork_of", None):
-            # GitHub object has fork attribute, but Gist object has fork_of
+        if response_cache is None:
+            rate_limit = _get_rate_limit(g)
+        if token_pool is not None and rate_limit is not None:
+            token_pool.update(access_token, "core", *rate_limit)
+        # we need remote_id to detect renamed repos/users
+        repo_data["remote_id"] = repo["id"]
+        if provider == "GitHub":
+            repo_data["default_branch"] = repo.get("default_branch")
+        if repo.get("fork") or repo.get("fork_of"):
+            # GitHub repo has fork attribute, but Gist has fork_of
             repo_data["fork"] = 1
         else:
             repo_data["fork"] = 0
@@ -282,6 +660,80 @@ def get_repo_data_from_github_api(provider, repo_url, access_token=None):
         return None
 
 
+def get_repos_data_from_github_graphql(repo_urls, access_token=None, api_url=GITHUB_API_URL, token_pool=None):
+    """
+    fetches remote_id, fork and default_branch of up to GRAPHQL_BATCH_SIZE GitHub repos with one GraphQL request.
+    returns {repo_url: repo_data}, repo_data is same as what get_repo_data_from_github_api returns,
+    fork is 404 for repos which dont exist anymore.
+    repos with other errors (e.g. blocked repos) are not in the result, they must be fetched with REST API
+    to get their status code.
+    if a token_pool is given, access_token is taken from the pool (GraphQL has its own rate limit).
+    """
+    if len(repo_urls) > GRAPHQL_BATCH_SIZE:
+        raise Exception(f"max {GRAPHQL_BATCH_SIZE} repos can be fetched at once")
+    # each repo is queried with an alias and its owner and name are passed as variables
+    variables = {}
+    definitions = []
+    fields = []
+    aliases = {}
+    for i, repo_url in enumerate(repo_urls):
+        owner, name = repo_url.split("github.com/")[-1].split("/", 1)
+        variables[f"o{i}"], variables[f"n{i}"] = owner, name
+        definitions.append(f"$o{i}: String!, $n{i}: String!")
+        fields.append(f"r{i}: repository(owner: $o{i}, name: $n{i}) "
+                      f"{{ databaseId isFork defaultBranchRef {{ name }} }}")
+        aliases[f"r{i}"] = repo_url
+    query = f"query({', '.join(definitions)}) {{ {' '.join(fields)} }}"
+    if token_pool is not None:
+        access_token = get_token(token_pool, "graphql")
+    response = requests.post(f"{api_url.rstrip('/')}/graphql", json={"query": query, "variables": variables},
+                             headers={"Authorization": f"bearer {access_token}"}, timeout=60)
+    reset_ts = int(response.headers.get("X-RateLimit-Reset", time.time()))
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    remaining = int(remaining) if remaining is not None else None
+    rate_limited = _is_rate_limited(response.status_code, response.text, remaining)
+    if token_pool is not None:
+        if rate_limited:
+            token_pool.exhausted(access_token, "graphql", reset_ts)
+        elif remaining is not None:
+            token_pool.update(access_token, "graphql", remaining, reset_ts)
+    if response.status_code != 200:
+        data = {"message": response.text}
+        if rate_limited:
+            data["minutes_until_reset"] = _get_minutes_until_reset(reset_ts)
+            raise RateLimitExceededException(response.status_code, data)
+        raise GithubException(response.status_code, data)
+    result = response.json()
+    # errors of each repo, e.g. {"type": "NOT_FOUND", "path": ["r0"], ...}
+    errors = {}
+    for error in result.get("errors") or []:
+        if error.get("type") == "RATE_LIMITED":
+            if token_pool is not None:
+                token_pool.exhausted(access_token, "graphql", reset_ts)
+            raise RateLimitExceededException(403, {"message": error.get("message"),
+                                                   "minutes_until_reset": _get_minutes_until_reset(reset_ts)})
+        if error.get("path"):
+            errors[error["path"][0]] = error.get("type")
+        elif not result.get("data"):
+            # error of the whole query
+            raise GithubException(response.status_code, result)
+
+    repos_data = {}
+    for alias, repo_url in aliases.items():
+        repo = (result.get("data") or {}).get(alias)
+        if repo is not None:
+            repos_data[repo_url] = {
+                "remote_id": repo["databaseId"],
+                "fork": 1 if repo["isFork"] else 0,
+                # empty repos have no default branch
+                "default_branch": (repo["defaultBranchRef"] or {}).get("name"),
+            }
+        elif errors.get(alias) == "NOT_FOUND":
+            # repo doesnt exists anymore
+            repos_data[repo_url] = {"remote_id": None, "fork": 404, "default_branch": None}
+    return repos_data
+
+
 def get_repo2docker_image():
     """
     Get the r2d image used in mybinder.org
@@ -293,40 +745,97 @@ def get_repo2docker_image():
     return r2d_image
 
 
-def get_mybinder_repo2docker_history():
-    with tempfile.TemporaryDirectory() as tmp_dir_path:
-        # clone mybinder.org-deploy repo
-        command = ["git", "clone", "https://github.com/jupyterhub/mybinder.org-deploy.git", tmp_dir_path]
-        result = git_execute(command)
+MYBINDER_DEPLOY_REPO_URL = "https://github.com/jupyterhub/mybinder.org-deploy.git"
 
-        # get change history of repo2docker
-        # git log --date=iso8601-strict -L /repo2docker/,+1:mybinder/values.yaml
-        command = ["git", "log", "--date=iso8601-strict", "-L", "/repo2docker/,+1:mybinder/values.yaml"]
-        result = git_execute(command, tmp_dir_path)
 
-        r2d_history = {}
-        for line in result.stdout.splitlines():
-            # print(line)
-            if line.startswith("commit"):
-                commit = line[6:].strip()
-            elif line.startswith("Date:"):
-                date_str = line[5:].strip()
-                date_ = datetime.fromisoformat(date_str)
-                # have date in UTC and in isoformat
-                # this also removes timezone info
-                date_str_utc = datetime.utcfromtimestamp(date_.timestamp()).isoformat()
-                # print(date_str, date_, date_str_utc)
-            elif line.startswith("- "):
-                old_image = line.split(":", maxsplit=1)[-1].strip()
-            elif line.startswith("+ "):
-                new_image = line.split(":", maxsplit=1)[-1].strip()
-                if old_image:
-                    # to skip first commit which adds repo2docker
-                    r2d_history[date_str_utc] = {"commit": commit, "old": old_image, "new": new_image}
-                old_image = None
+def _parse_mybinder_repo2docker_history(repo_dir):
+    # get change history of repo2docker
+    # git log --date=iso8601-strict -L /repo2docker/,+1:mybinder/values.yaml
+    command = ["git", "log", "--date=iso8601-strict", "-L", "/repo2docker/,+1:mybinder/values.yaml"]
+    result = git_execute(command, repo_dir)
+
+    r2d_history = {}
+    for line in result.stdout.splitlines():
+        # print(line)
+        if line.startswith("commit"):
+            commit = line[6:].strip()
+        elif line.startswith("Date:"):
+            date_str = line[5:].strip()
+            date_ = datetime.fromisoformat(date_str)
+            # have date in UTC and in isoformat
+            # this also removes timezone info
+            date_str_utc = datetime.utcfromtimestamp(date_.timestamp()).isoformat()
+            # print(date_str, date_, date_str_utc)
+        elif line.startswith("- "):
+            old_image = line.split(":", maxsplit=1)[-1].strip()
+        elif line.startswith("+ "):
+            new_image = line.split(":", maxsplit=1)[-1].strip()
+            if old_image:
+                # to skip first commit which adds repo2docker
+                r2d_history[date_str_utc] = {"commit": commit, "old": old_image, "new": new_image}
+            old_image = None
+    return r2d_history
+
+
+def get_mybinder_repo2docker_history(cache_dir=None, offline=False):
+    """
+    returns change history of repo2docker image in mybinder.org as dict {commit date: {commit, old, new}}
+    if cache_dir is given, clone of mybinder.org-deploy repo and parsed history are kept there,
+    so next runs only fetch new commits and parse history again only if there is a new commit.
+    """
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir_path:
+            # clone mybinder.org-deploy repo
+            command = ["git", "clone", MYBINDER_DEPLOY_REPO_URL, tmp_dir_path]
+            git_execute(command)
+            return _parse_mybinder_repo2docker_history(tmp_dir_path)
+
+    history_file = os.path.join(cache_dir, "r2d_history.json")
+    try:
+        with open(history_file, "r") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        cached = None
+    if offline:
+        if cached is None:
+            raise FileNotFoundError(f"{history_file} doesnt exist")
+        return cached["history"]
+
+    repo_dir = os.path.join(cache_dir, "mybinder.org-deploy")
+    if os.path.exists(repo_dir):
+        # only fetch new commits
+        git_execute(["git", "fetch", "origin"], repo_dir)
+        git_execute(["git", "reset", "--hard", "FETCH_HEAD"], repo_dir)
+    else:
+        git_execute(["git", "clone", MYBINDER_DEPLOY_REPO_URL, repo_dir])
+    head = git_execute(["git", "rev-parse", "HEAD"], repo_dir).stdout.strip()
+    if cached is not None and cached["head"] == head:
+        return cached["history"]
+
+    r2d_history = _parse_mybinder_repo2docker_history(repo_dir)
+    with open(history_file, "w") as f:
+        json.dump({"head": head, "history": r2d_history}, f, indent=1)
     return r2d_history
 
 
+def get_r2d_history_index(r2d_history):
+    """
+    returns r2d history as a sorted interval index (boundaries, versions):
+    launches until (and including) boundaries[i] used versions[i] and
+    launches after the last boundary used versions[-1], which is the latest version.
+    """
+    boundaries = []
+    versions = []
+    for commit_date in sorted(r2d_history):
+        # event timestamp is already in UTC and in minute resolution
+        # have commit date also in minute resolution
+        boundaries.append(datetime.fromisoformat(commit_date).replace(second=0, microsecond=0).isoformat())
+        versions.append(r2d_history[commit_date]["old"])
+    # latest
+    versions.append(r2d_history[commit_date]["new"])
+    return boundaries, versions
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
@@ -0,0 +1,205 @@
+"""
+Script to validate `utils.detect_buildpack_from_tree` against repo2docker detectors (`utils.detect_buildpack`).
+
+Both are run on the same commits of a fixture corpus, which covers the rules of each buildpack,
+and optionally on repos of a `repo` table. This should be run after repo2docker is updated.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from sqlite_utils import Database
+from utils import detect_buildpack, detect_buildpack_from_tree, get_git_tree, git_execute, checkout_detect_files, \
+    REPO_TABLE
+
+# fixture name: {path: content}, content is a file content or ("symlink", target) or ("submodule", commit)
+FIXTURES = {
+    "empty": {"README.md": "# empty"},
+    "requirements": {"requirements.txt": "numpy"},
+    "setup_py": {"setup.py": "from setuptools import setup"},
+    "setup_py_in_binder": {"binder/setup.py": "", "binder/apt.txt": "vim"},
+    "setup_py_folder": {"setup.py/x": ""},
+    "binder_environment": {"binder/environment.yml": "dependencies: [numpy]", "requirements.txt": "numpy"},
+    "root_environment_with_binder": {"binder/apt.txt": "vim", "environment.yml": "dependencies: [numpy]"},
+    "dotbinder_dockerfile": {".binder/Dockerfile": "FROM python:3.7"},
+    "binder_and_dotbinder": {"binder/a": "", ".binder/b": ""},
+    "binder_and_dotbinder_legacy": {"binder/a": "", ".binder/b": "", "Dockerfile": "FROM andrewosh/binder-base"},
+    "binder_file": {"binder": "not a folder", "Dockerfile": "FROM python:3.7"},
+    "legacy": {"Dockerfile": "# comment\nFROM andrewosh/binder-base:latest\n"},
+    "legacy_commented": {"Dockerfile": "FROM python:3.7 # andrewosh/binder-base\n"},
+    "legacy_second_from": {"Dockerfile": "FROM python:3.7 AS base\nFROM andrewosh/binder-base\n"},
+    "legacy_crlf": {"Dockerfile": "FROM Andrewosh/Binder-Base\r\nRUN ls\r\n"},
+    "dockerfile_in_binder": {"binder/Dockerfile": "FROM python:3.7", "environment.yml": ""},
+    "root_dockerfile_with_binder": {"binder/environment.yml": "", "Dockerfile": "FROM python:3.7"},
+    "julia_project": {"Project.toml": "[deps]", "REQUIRE": "julia 0.6"},
+    "julia_project_binder": {"binder/JuliaProject.toml": "[deps]"},
+    "julia_require": {"REQUIRE": "julia 0.6", "environment.yml": ""},
+    "nix": {"default.nix": "{}", "runtime.txt": "r-2019-01-01"},
+    "nix_binder": {"binder/default.nix": "{}", "Dockerfile": "FROM python:3.7"},
+    "r_runtime": {"runtime.txt": "r-2019-01-01", "environment.yml": ""},
+    "r_runtime_version": {"binder/runtime.txt": "r-3.6-2019-01-01\n"},
+    "r_runtime_invalid_date": {"runtime.txt": "r-2019-13-45"},
+    "r_description": {"DESCRIPTION": "Package: x", "requirements.txt": ""},
+    "r_description_in_binder": {"binder/DESCRIPTION": "Package: x"},
+    "r_description_with_binder": {"binder/apt.txt": "", "DESCRIPTION": "Package: x"},
+    "stencila_r": {"paper/manifest.xml": '<manifest><documents><document path="paper.jats.xml"/>'
+                                         '</documents></manifest>',
+                   "paper/paper.jats.xml": '<article><code specific-use="source" language="r">x</code></article>'},
+    "stencila_python": {"a/b/manifest.xml": '<manifest><documents><document path="doc.xml"/></documents></manifest>',
+                        "a/b/doc.xml": '<article><code specific-use="source" language="py">x</code></article>',
+                        "environment.yml": ""},
+    "stencila_no_documents": {"paper/manifest.xml": "<manifest/>"},
+    "stencila_two_manifests": {"a/manifest.xml": "<manifest/>", "b/manifest.xml": "<manifest/>"},
+    "stencila_root_manifest": {"manifest.xml": "<manifest/>"},
+    "python_runtime": {"runtime.txt": "python-3.7", "Pipfile": ""},
+    "python_runtime_in_binder": {"binder/runtime.txt": "python-2.7", "binder/requirements.txt": ""},
+    "other_runtime": {"runtime.txt": "julia-1.0", "Pipfile.lock": "{}", "setup.py": ""},
+    "pipfile": {"Pipfile": "", "requirements.txt": ""},
+    "pipfile_lock_binder": {"binder/Pipfile.lock": "{}", "Pipfile": ""},
+    "runtime_folder": {"runtime.txt/x": "", "requirements.txt": ""},
+    "symlink_requirements": {"reqs.txt": "numpy", "requirements.txt": ("symlink", "reqs.txt")},
+    "symlink_binder": {"real/Dockerfile": "FROM python:3.7", "binder": ("symlink", "real")},
+    "symlink_runtime": {"r.txt": "r-2019-01-01", "runtime.txt": ("symlink", "r.txt")},
+    "broken_symlink": {"environment.yml": ("symlink", "missing.yml")},
+    "submodule_binder": {"binder": ("submodule", "0" * 39 + "1")},
+}
+
+
+def create_fixture_repo(name, files, repos_dir):
+    """creates a git repo of a fixture with a single commit, returns its path"""
+    repo_dir = os.path.join(repos_dir, name)
+    git_execute(["git", "init", "-q", repo_dir])
+    submodules = []
+    for path, content in files.items():
+        if isinstance(content, tuple) and content[0] == "submodule":
+            submodules.append((path, content[1]))
+            continue
+        file_path = os.path.join(repo_dir, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if isinstance(content, tuple):
+            os.symlink(content[1], file_path)
+        else:
+            # newline="" to keep line endings as they are
+            with open(file_path, "w", newline="") as f:
+                f.write(content)
+    git_execute(["git", "add", "-A"], repo_dir)
+    for path, commit in submodules:
+        # only a gitlink in the index, as if the submodule was not initialized
+        git_execute(["git", "update-index", "--add", "--cacheinfo", f"160000,{commit},{path}"], repo_dir)
+    git_execute(["git", "-c", "user.name=fixture", "-c", "user.email=fixture@example.org",
+                 "commit", "-q", "-m", name], repo_dir)
+    return repo_dir
+
+
+def _run(detect, *args):
+    """returns result of detection or the exception as a string"""
+    try:
+        return detect(*args)
+    except Exception as e:
+        return f"{e.__class__.__name__}: {e}"
+
+
+def detect_after_checkout(tree, resolved_ref, repo_dir):
+    """detects as in blobless mode of create_repo_table, when detection from tree is undecided:
+    only the detect files are checked out into a clone without checkout, or the whole tree if needed"""
+    with tempfile.TemporaryDirectory() as clone_dir:
+        git_execute(["git", "clone", "-q", "--no-checkout", repo_dir, clone_dir])
+        if not checkout_detect_files(tree, resolved_ref, clone_dir):
+            git_execute(["git", "checkout", "-q", resolved_ref], clone_dir)
+        return detect_buildpack(clone_dir)
+
+
+def validate_repo(repo_dir, ref="HEAD"):
+    """returns (result of detect_buildpack, result of detect_buildpack_from_tree, result of detect_after_checkout)
+    for ref of a cloned repo, the last one is None if detection from tree is decided"""
+    git_execute(["git", "checkout", "-q", ref], repo_dir)
+    command = ["git", "rev-parse", "HEAD"]
+    resolved_ref = git_execute(command, repo_dir).stdout.strip()
+    expected = _run(detect_buildpack, repo_dir)
+    tree = get_git_tree(resolved_ref, repo_dir)
+    detected = _run(detect_buildpack_from_tree, tree, repo_dir)
+    checkout = None
+    if detected is None:
+        checkout = _run(detect_after_checkout, tree, resolved_ref, repo_dir)
+    return expected, detected, checkout
+
+
+def get_db_repos(db_name, limit):
+    db = Database(db_name)
+    query = f'SELECT repo_url, resolved_ref FROM {REPO_TABLE} ' \
+            f'WHERE buildpack IS NOT NULL AND resolved_ref IS NOT NULL AND resolved_ref!="404" ' \
+            f'ORDER BY launch_count DESC LIMIT {limit};'
+    return list(db.execute(query).fetchall())
+
+
+def validate_tree_detection(db_name=None, limit=100):
+    """returns number of mismatches"""
+    results = {"match": 0, "undecided": 0, "mismatch": 0}
+    with tempfile.TemporaryDirectory() as repos_dir:
+        repos = []
+        for name, files in FIXTURES.items():
+            fixture_dir = create_fixture_repo(name, files, os.path.join(repos_dir, "fixtures"))
+            # validate on a clone as in create_repo_table, e.g. submodules are empty folders then
+            repo_dir = os.path.join(repos_dir, name)
+            git_execute(["git", "clone", "-q", fixture_dir, repo_dir])
+            repos.append((name, repo_dir, "HEAD"))
+        if db_name:
+            for i, (repo_url, resolved_ref) in enumerate(get_db_repos(db_name, limit)):
+                repo_dir = os.path.join(repos_dir, f"repo_{i}")
+                try:
+                    git_execute(["git", "clone", "-q", repo_url, repo_dir], env={"GIT_TERMINAL_PROMPT": "0"})
+                except Exception as e:
+                    print(f"{repo_url}: skipped, {e}")
+                    continue
+                repos.append((repo_url, repo_dir, resolved_ref))
+
+        for name, repo_dir, ref in repos:
+            expected, detected, checkout = validate_repo(repo_dir, ref)
+            if detected is None:
+                # fallback of blobless mode must give the same result too
+                status = "undecided" if checkout == expected else "mismatch"
+            elif detected == expected:
+                status = "match"
+            else:
+                status = "mismatch"
+            results[status] += 1
+            if status != "match" or verbose:
+                msg = f"{status:<10} {name}: repo2docker: {expected}, tree: {detected}"
+                if detected is None:
+                    msg += f", checkout: {checkout}"
+                print(msg)
+    print(", ".join(f"{count} {status}" for status, count in results.items()))
+    return results["mismatch"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='This script validates buildpack detection from git tree listings '
+                                                 '(utils.detect_buildpack_from_tree) against repo2docker detectors '
+                                                 '(utils.detect_buildpack) on a fixture corpus and optionally on '
+                                                 f'most launched repos of `{REPO_TABLE}` table. '
+                                                 'Undecided repos are detected with repo2docker after a checkout of detect files, '
+                                                 'mismatches must be fixed.'
+                                                 '\nExample command: '
+                                                 '\n\tpython validate_tree_detection.py -n example.db -l 50',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--db_name', required=False, default=None,
+                        help=f'Database with `{REPO_TABLE}` table, its repos are cloned and validated too.')
+    parser.add_argument('-l', '--limit', type=int, default=100,
+                        help='Number of repos to validate from database. Default is 100.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='Print matches too. Default is False.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    global verbose
+
+    args = get_args()
+    verbose = args.verbose
+    mismatches = validate_tree_detection(args.db_name, args.limit)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()